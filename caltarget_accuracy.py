@@ -0,0 +1,253 @@
+import io
+import os
+import argparse
+import numpy as np
+import pandas as pd
+
+from caltarget_reference import ReferenceIndex
+
+'''
+Caltarget accuracy over the mission for ChemCam and SuperCam
+
+Compares the predicted (MOC) compositions of calibration target
+observations with their true compositions, per target and range of
+sols, as in the "compare ChemCam/SuperCam pred true" notebooks. Each
+statistic is one grouped pass over the whole table instead of loops
+over targets and rows, so every (target, sol range) is computed once:
+
+    rmse_by_sol          RMSE of each oxide per target and sol range
+    rmse_summary         mean and std of those RMSEs across targets per
+                         sol range, with empty ranges filled in
+    pred_true_summary    mean and std of the predictions per target,
+                         with the true values
+
+    python caltarget_accuracy.py ChemCam <LIBS_CCS_metadata_w_moc.csv> <Millennium_COMPS.xlsx>
+    python caltarget_accuracy.py SuperCam <LIBS_RDR_metadata_w_pred_comps.csv> <SuperCam_cal_metadata.csv> SCCT_key.xlsx
+
+write <instrument>_RMSE_bysol.csv, <instrument>_RMSE_bysol_summary.csv
+and <instrument>_pred_true_summary.csv.
+'''
+
+# target column of each instrument's tables
+TARGET = {
+    'ChemCam':'Target',
+    'SuperCam':'target'
+}
+
+#-----------------#
+#  LOAD AND MATCH #
+#-----------------#
+
+def load_rows(meta_path, target, targets=None, contains=None, max_sol=None, min_sol=None):
+    '''
+    Rows of a metadata table for the targets named in targets or
+    containing contains, and sols from min_sol to max_sol, in the
+    table's (sol, pkey) order. If the ingest left a target-partitioned
+    copy next to the table (<name>_by_target.csv and its index, see
+    pds_target_index.py), only the blocks of matching targets and sols
+    are read from it.
+    '''
+    base = meta_path[:-4] if meta_path.endswith('.csv') else meta_path
+    copy_path, index_path = base+'_by_target.csv', base+'_by_target_index.csv'
+
+    # a copy older than the table is out of date
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(meta_path):
+        blocks = pd.read_csv(index_path, dtype={'target':str})
+        keep = pd.Series(True, index=blocks.index)
+        if targets is not None:
+            keep &= blocks.target.isin(targets)
+        if contains is not None:
+            keep &= blocks.target.str.contains(contains, regex=False)
+        if min_sol is not None:
+            keep &= blocks.last_sol >= min_sol
+        if max_sol is not None:
+            keep &= blocks.first_sol <= max_sol
+        blocks = blocks[keep]
+
+        with open(copy_path, 'rb') as f:
+            parts = [f.readline()]
+            for offset, length in zip(blocks.offset, blocks.length):
+                f.seek(offset)
+                parts.append(f.read(length))
+        df = pd.read_csv(io.BytesIO(b''.join(parts)), dtype={target:str})
+        df = df.sort_values(['sol', 'pkey'], ignore_index=True)
+    else:
+        df = pd.read_csv(meta_path)
+        if targets is not None:
+            df = df[df[target].isin(targets)]
+        if contains is not None:
+            df = df[df[target].str.contains(contains, regex=False, na=False)]
+
+    if min_sol is not None:
+        df = df[df.sol >= min_sol]
+    if max_sol is not None:
+        df = df[df.sol <= max_sol]
+    return df.reset_index(drop=True)
+
+def load_chemcam(meta_path, comps_path, max_sol=None, reference=None):
+    '''
+    ChemCam caltarget observations with their true compositions,
+    and the oxide columns. Caltargets and true compositions come from
+    the reference index (caltarget_reference.py), built from comps_path
+    when needed.
+    '''
+    reference = reference or ReferenceIndex(millennium=comps_path)
+    truth = reference.truth('ChemCam')
+    df = load_rows(meta_path, 'Target', targets=list(truth.index), max_sol=max_sol)
+    comp_cols = [c.split(' ')[0] for c in df.columns if 'RMSEP' in c]
+
+    df = df.merge(truth[[c+'_actual' for c in comp_cols]], left_on='Target', right_index=True)
+    return df.reset_index(drop=True), comp_cols
+
+def load_supercam(meta_path, actual_path, key_path, max_sol=None, reference=None):
+    '''
+    SuperCam caltarget (scct) observations with their true compositions,
+    and the oxide columns. True compositions come from the reference
+    index, built from actual_path and key_path when needed.
+    '''
+    df = load_rows(meta_path, 'target', contains='scct', max_sol=max_sol)
+    df = df.sort_values('target', ignore_index=True)
+    comp_cols = [c for c in df.columns if 'O' in c and 'stdev' not in c]
+
+    reference = reference or ReferenceIndex(supercam_cal=actual_path, scct_key=key_path)
+    actual = reference.truth('SuperCam')[[c+'_actual' for c in comp_cols]]
+    df = df.merge(actual, how='left', left_on='target', right_index=True)
+    return df, comp_cols
+
+#------------#
+# SOL RANGES #
+#------------#
+
+def sol_ranges(sols, width=100, first_sol=None):
+    '''
+    Sol range of each sol as an ordered categorical of '<first>-<end>'
+    labels, width sols each from first_sol (default the earliest sol).
+    Every range up to the last sol is a category, observed or not.
+    '''
+    sols = np.asarray(sols, dtype='int64')
+    if first_sol is None:
+        first_sol = int(sols.min())
+    codes = (sols - first_sol) // width
+    # sols before first_sol are left out of every range
+    codes[codes < 0] = -1
+    starts = first_sol + width * np.arange(max(int(codes.max()) + 1, 0))
+    return pd.Categorical.from_codes(codes, categories=[f'{s}-{s+width}' for s in starts], ordered=True)
+
+def add_sol_range(df, width=100, first_sol=None):
+    df = df.copy()
+    df.insert(list(df.columns).index('sol')+1, 'sol_range', sol_ranges(df.sol, width, first_sol))
+    return df
+
+def range_start(labels):
+    return [int(str(x).split('-')[0]) for x in labels]
+
+#------------#
+# STATISTICS #
+#------------#
+
+def bin_stats(df, comp_cols, target='Target'):
+    '''
+    Per target and sol range (in order of first appearance): number of
+    observations n and, for each oxide, the RMSE against the true value
+    and the mean and std of the predictions.
+    Oxides without a true value for a target have a NaN RMSE.
+    '''
+    pred = df[comp_cols].to_numpy(dtype='float64')
+    actual = df[[c+'_actual' for c in comp_cols]].to_numpy(dtype='float64')
+    values = pd.DataFrame(np.hstack([pred, (pred - actual)**2]),
+                          columns=comp_cols + [c+'_se' for c in comp_cols])
+
+    groups = values.groupby([df[target].to_numpy(), df.sol_range.to_numpy()], sort=False)
+    means = groups.mean()
+    # one observation is its absolute error, sqrt of one squared error
+    rmse = np.sqrt(means[[c+'_se' for c in comp_cols]])
+    rmse.columns = [c+'_RMSE' for c in comp_cols]
+    stats = pd.concat([groups.size().rename('n'),
+                       rmse,
+                       means[comp_cols].add_suffix('_mean'),
+                       groups[comp_cols].std().add_suffix('_std')], axis=1)
+
+    stats.index.names = [target, 'sol_range']
+    stats = stats.reset_index()
+    stats['sol_range'] = pd.Categorical(stats.sol_range, categories=df.sol_range.cat.categories, ordered=True)
+    return stats
+
+def rmse_by_sol(stats, comp_cols, target='Target'):
+    return stats[[target, 'sol_range'] + [c+'_RMSE' for c in comp_cols]]
+
+def rmse_summary(rmse_results, comp_cols):
+    '''
+    Mean and std across targets of each oxide's RMSE per sol range, with
+    the number of targets observed (n_samples). Ranges without
+    observations are kept with n_samples 0.
+    '''
+    rmse_cols = [c+'_RMSE' for c in comp_cols]
+    groups = rmse_results.groupby('sol_range', observed=False)
+    summary = pd.concat([groups[rmse_cols].mean().add_suffix('_mean'),
+                         groups[rmse_cols].std().add_suffix('_std')], axis=1)
+    summary = summary[sorted(summary.columns)]
+    summary.insert(0, 'n_samples', groups.size())
+    summary = summary.reset_index()
+    summary['sol_range'] = summary.sol_range.astype(str)
+
+    # sort for plotting
+    summary['min_sol'] = range_start(summary.sol_range)
+    return summary.sort_values('min_sol', ignore_index=True)
+
+def pred_true_summary(df, comp_cols, target='Target'):
+    '''
+    Per target: number of observations (n_dups), mean and std of the
+    predictions and the true value of each oxide
+    '''
+    actual_cols = [c+'_actual' for c in comp_cols]
+    groups = df.groupby(target)
+    results = pd.concat([groups[comp_cols].mean().add_suffix('_mean'),
+                         groups[comp_cols].std().add_suffix('_std'),
+                         groups[actual_cols].first()], axis=1)
+    results = results[sorted(results.columns)]
+    results.insert(0, 'n_dups', groups.size())
+    return results.reset_index()
+
+def accuracy_tables(df, comp_cols, target='Target', width=100):
+    '''
+    RMSE by sol, its summary and the pred/true summary of a table of
+    caltarget observations with <oxide> and <oxide>_actual columns
+    '''
+    df = add_sol_range(df, width)
+    rmse_results = rmse_by_sol(bin_stats(df, comp_cols, target), comp_cols, target)
+    return rmse_results, rmse_summary(rmse_results, comp_cols), pred_true_summary(df, comp_cols, target)
+
+def write_tables(instrument, rmse_results, summary, pred_true, folder=''):
+    rmse_results.to_csv(os.path.join(folder, f'{instrument}_RMSE_bysol.csv'), index=False)
+    summary.to_csv(os.path.join(folder, f'{instrument}_RMSE_bysol_summary.csv'), index=False)
+    pred_true.to_csv(os.path.join(folder, f'{instrument}_pred_true_summary.csv'), index=False)
+    print(f'{instrument}: {len(rmse_results)} target/sol ranges from {pred_true.n_dups.sum()} caltarget observations')
+
+def export(instrument, df, comp_cols, folder='', width=100):
+    write_tables(instrument, *accuracy_tables(df, comp_cols, TARGET[instrument], width), folder)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Caltarget accuracy by sol range')
+    commands = parser.add_subparsers(dest='instrument', required=True)
+
+    chemcam_parser = commands.add_parser('ChemCam')
+    chemcam_parser.add_argument('meta', help='LIBS_CCS_metadata_w_moc .csv')
+    chemcam_parser.add_argument('comps', help='Millennium compositions .xlsx')
+
+    supercam_parser = commands.add_parser('SuperCam')
+    supercam_parser.add_argument('meta', help='LIBS_RDR_metadata_w_pred_comps .csv')
+    supercam_parser.add_argument('actual', help='SuperCam calibration metadata .csv')
+    supercam_parser.add_argument('key', help='SCCT_key.xlsx')
+
+    for command in [chemcam_parser, supercam_parser]:
+        command.add_argument('--max-sol', type=int)
+        command.add_argument('--width', type=int, default=100, help='sols per range')
+        command.add_argument('--out', default='', help='folder for the .csv files')
+    args = parser.parse_args()
+
+    if args.instrument == 'ChemCam':
+        df, comp_cols = load_chemcam(args.meta, args.comps, max_sol=args.max_sol)
+    else:
+        df, comp_cols = load_supercam(args.meta, args.actual, args.key, max_sol=args.max_sol)
+    export(args.instrument, df, comp_cols, args.out, args.width)
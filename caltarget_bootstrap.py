@@ -0,0 +1,244 @@
+import os
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from statistics import NormalDist
+from concurrent.futures import ProcessPoolExecutor
+
+import caltarget_accuracy as ca
+
+'''
+Confidence intervals for the caltarget accuracy statistics
+
+Many target/sol range groups hold only a handful of observations, where
+the std across targets says little. rmse_intervals gives each target,
+sol range and oxide RMSE a bootstrap percentile interval and a
+jackknife (normal) interval; r2_intervals does the same for the R2 of
+mean predicted against true compositions across targets, as plotted in
+"combined plots".
+
+Resamples are drawn as index arrays for all groups of the same size at
+once, in batches, and the group sizes are spread over a process pool.
+Each group size gets its own seed from seed, so results are the same
+for any number of processes.
+
+    python caltarget_bootstrap.py ChemCam <LIBS_CCS_metadata_w_moc.csv> <Millennium_COMPS.xlsx> --n-boot 2000
+    python caltarget_bootstrap.py r2 ChemCam_pred_true_summary.csv SuperCam_pred_true_summary.csv
+
+A group with one observation has a zero-width bootstrap interval and no
+jackknife interval.
+'''
+
+# resampled values held at once per batch
+batch_size = 2**22
+
+def _quantiles(level):
+    return 50 * (1 - level), 50 * (1 + level)
+
+def _percentiles(values, level):
+    '''
+    Lower and upper percentiles of values along the last axis, ignoring
+    NaNs (linear interpolation, as np.nanpercentile, without its
+    per-slice loop)
+    '''
+    # NaNs sort last
+    values = np.sort(values, axis=-1)
+    m = (~np.isnan(values)).sum(axis=-1, keepdims=True)
+    bounds = []
+    for q in _quantiles(level):
+        pos = q / 100 * np.maximum(m - 1, 0)
+        lo = np.floor(pos).astype('int64')
+        hi = np.ceil(pos).astype('int64')
+        v_lo = np.take_along_axis(values, lo, axis=-1)
+        v_hi = np.take_along_axis(values, hi, axis=-1)
+        bound = (v_lo + (v_hi - v_lo) * (pos - lo))[..., 0]
+        bound[m[..., 0] == 0] = np.nan
+        bounds.append(bound)
+    return bounds
+
+def _rmse_bounds(se, valid, n_boot, level, seed):
+    '''
+    Bootstrap and jackknife bounds of the RMSE of G groups of n
+    observations of k oxides (se, valid: G x n x k, se 0 where not valid)
+    '''
+    rng = np.random.default_rng(seed)
+    G, n, k = se.shape
+    low, high = np.empty((G, k)), np.empty((G, k))
+
+    # groups per pass and resamples per draw, so about batch_size values are held at once
+    per_pass = max(1, batch_size // (n_boot * n * k))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for first in range(0, G, per_pass):
+            chunk_se = se[first:first+per_pass]
+            chunk_valid = valid[first:first+per_pass]
+            g = len(chunk_se)
+            group = np.arange(g)[:, None, None]
+            boots = np.empty((g, k, n_boot))
+            step = max(1, batch_size // (g * n * k))
+            for start in range(0, n_boot, step):
+                b = min(step, n_boot - start)
+                idx = rng.integers(0, n, (g, b, n))
+                rmse = np.sqrt(chunk_se[group, idx].sum(axis=2) / chunk_valid[group, idx].sum(axis=2))
+                boots[:, :, start:start+b] = rmse.transpose(0, 2, 1)
+            low[first:first+g], high[first:first+g] = _percentiles(boots, level)
+
+        # leave each valid observation out in turn
+        total = se.sum(axis=1)
+        count = valid.sum(axis=1)
+        loo = np.sqrt((total[:, None, :] - se) / (count[:, None, :] - valid))
+        loo[~valid] = np.nan
+
+    with warnings.catch_warnings():
+        # groups without any true value are all NaN
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        jack_se = np.sqrt((count - 1) / count * np.nansum((loo - np.nanmean(loo, axis=1, keepdims=True))**2, axis=1))
+    jack_se[count < 2] = np.nan
+    return low, high, jack_se
+
+def rmse_intervals(df, comp_cols, target='Target', width=100, n_boot=1000, level=0.95, seed=0, n_procs=None):
+    '''
+    Per target, sol range and oxide: number of observations with a true
+    value, RMSE, bootstrap percentile interval (boot_low, boot_high) and
+    jackknife standard error and interval at the given level.
+    n_procs None uses one process per core, 0 runs in this process.
+    '''
+    df = ca.add_sol_range(df, width)
+    pred = df[comp_cols].to_numpy(dtype='float64')
+    actual = df[[c+'_actual' for c in comp_cols]].to_numpy(dtype='float64')
+    se = (pred - actual)**2
+    valid = ~np.isnan(se)
+    se[~valid] = 0
+
+    groups = df.groupby([target, 'sol_range'], sort=False, observed=True)
+    codes = groups.ngroup().to_numpy()
+    sizes = np.bincount(codes)
+    order = np.argsort(codes, kind='stable')
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+
+    # groups of the same size are resampled together
+    tasks = []
+    by_size = {n:np.flatnonzero(sizes == n) for n in np.unique(sizes)}
+    seeds = np.random.SeedSequence(seed).spawn(len(by_size))
+    for (n, gs), task_seed in zip(by_size.items(), seeds):
+        rows = order[starts[gs][:, None] + np.arange(n)]
+        tasks.append((se[rows], valid[rows], n_boot, level, task_seed))
+
+    if n_procs == 0:
+        results = [_rmse_bounds(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            results = list(pool.map(_rmse_bounds, *zip(*tasks)))
+
+    n_groups, k = len(sizes), len(comp_cols)
+    low, high, jack_se = (np.empty((n_groups, k)) for _ in range(3))
+    for gs, (l, h, s) in zip(by_size.values(), results):
+        low[gs], high[gs], jack_se[gs] = l, h, s
+
+    total = np.add.reduceat(se[order], starts, axis=0)
+    count = np.add.reduceat(valid[order].astype('int64'), starts, axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rmse = np.sqrt(total / count)
+    z = NormalDist().inv_cdf((1 + level) / 2)
+
+    index = groups.size().index
+    results = pd.DataFrame({
+        target:np.repeat(index.get_level_values(0), k),
+        'sol_range':np.repeat(index.get_level_values(1).astype(str), k),
+        'oxide':np.tile(comp_cols, n_groups),
+        'n':count.ravel(),
+        'RMSE':rmse.ravel(),
+        'boot_low':low.ravel(),
+        'boot_high':high.ravel(),
+        'jack_se':jack_se.ravel(),
+    })
+    results['jack_low'] = (results.RMSE - z * results.jack_se).clip(lower=0)
+    results['jack_high'] = results.RMSE + z * results.jack_se
+    return results
+
+def _r2(true, pred):
+    # R2 of each row of true against pred, NaN where the true values don't vary
+    ss_res = ((true - pred)**2).sum(axis=-1)
+    ss_tot = ((true - true.mean(axis=-1, keepdims=True))**2).sum(axis=-1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(ss_tot > 0, 1 - ss_res / ss_tot, np.nan)
+
+def r2_intervals(pred_true, comp_cols, n_boot=1000, level=0.95, seed=0):
+    '''
+    Per oxide: R2 of the mean predicted against the true composition
+    across targets (<oxide>_mean and <oxide>_actual columns of a
+    pred_true summary), resampling targets, with bootstrap percentile
+    and jackknife intervals
+    '''
+    rng = np.random.default_rng(seed)
+    z = NormalDist().inv_cdf((1 + level) / 2)
+    rows = []
+    for oxide in comp_cols:
+        t = pred_true[[oxide+'_actual', oxide+'_mean']].dropna().to_numpy(dtype='float64')
+        true, pred = t[:, 0], t[:, 1]
+        n = len(true)
+        if n < 2:
+            rows.append([oxide, n] + [np.nan]*6)
+            continue
+
+        idx = rng.integers(0, n, (n_boot, n))
+        boots = _r2(true[idx], pred[idx])
+        # leave each target out in turn
+        keep = ~np.eye(n, dtype=bool)
+        loo = _r2(np.broadcast_to(true, (n, n))[keep].reshape(n, n-1),
+                  np.broadcast_to(pred, (n, n))[keep].reshape(n, n-1))
+
+        low, high = _percentiles(boots, level)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category=RuntimeWarning)
+            jack_se = np.sqrt((n - 1) / n * np.nansum((loo - np.nanmean(loo))**2))
+        r2 = float(_r2(true, pred))
+        rows.append([oxide, n, r2, float(low), float(high), jack_se, r2 - z * jack_se, r2 + z * jack_se])
+
+    return pd.DataFrame(rows, columns=['oxide', 'n_targets', 'R2', 'boot_low', 'boot_high',
+                                       'jack_se', 'jack_low', 'jack_high'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bootstrap and jackknife intervals for caltarget accuracy')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    chemcam_parser = commands.add_parser('ChemCam', help='RMSE by sol range intervals')
+    chemcam_parser.add_argument('meta', help='LIBS_CCS_metadata_w_moc .csv')
+    chemcam_parser.add_argument('comps', help='Millennium compositions .xlsx')
+
+    supercam_parser = commands.add_parser('SuperCam', help='RMSE by sol range intervals')
+    supercam_parser.add_argument('meta', help='LIBS_RDR_metadata_w_pred_comps .csv')
+    supercam_parser.add_argument('actual', help='SuperCam calibration metadata .csv')
+    supercam_parser.add_argument('key', help='SCCT_key.xlsx')
+
+    r2_parser = commands.add_parser('r2', help='R2 intervals from pred_true summaries')
+    r2_parser.add_argument('summaries', nargs='+', help='<instrument>_pred_true_summary.csv files')
+
+    for command in [chemcam_parser, supercam_parser, r2_parser]:
+        command.add_argument('--n-boot', type=int, default=1000, help='bootstrap resamples')
+        command.add_argument('--level', type=float, default=0.95)
+        command.add_argument('--seed', type=int, default=0)
+        command.add_argument('--out', default='', help='folder for the .csv files')
+    for command in [chemcam_parser, supercam_parser]:
+        command.add_argument('--width', type=int, default=100, help='sols per range')
+        command.add_argument('--n-procs', type=int, default=None, help='processes (0 for this process only)')
+    args = parser.parse_args()
+
+    if args.command == 'r2':
+        results = []
+        for path in args.summaries:
+            pred_true = pd.read_csv(path)
+            comp_cols = [c[:-len('_actual')] for c in pred_true.columns if c.endswith('_actual')]
+            r2 = r2_intervals(pred_true, comp_cols, args.n_boot, args.level, args.seed)
+            r2.insert(0, 'summary', os.path.basename(path))
+            results.append(r2)
+        pd.concat(results, ignore_index=True).to_csv(os.path.join(args.out, 'R2_CI.csv'), index=False)
+    else:
+        if args.command == 'ChemCam':
+            df, comp_cols = ca.load_chemcam(args.meta, args.comps)
+        else:
+            df, comp_cols = ca.load_supercam(args.meta, args.actual, args.key)
+        results = rmse_intervals(df, comp_cols, ca.TARGET[args.command], args.width,
+                                 args.n_boot, args.level, args.seed, args.n_procs)
+        results.to_csv(os.path.join(args.out, f'{args.command}_RMSE_bysol_CI.csv'), index=False)
@@ -0,0 +1,253 @@
+import os
+import sqlite3
+import hashlib
+import pandas as pd
+
+'''
+Compiled caltarget reference index
+
+Maps each PDS target name to its canonical caltarget and that
+caltarget's true oxide composition, for both instruments:
+
+    ChemCam   Target -> PELLET NAME (ccct_key.csv) -> Millennium compositions
+              sheet, labels from ccct_key.csv
+    SuperCam  target -> Metadata Name (SCCT_key.xlsx) -> SuperCam calibration
+              metadata .csv, labels from the SCCT key Index column
+
+The sources are parsed once into a SQLite file and read from there
+afterwards. Each source's mtime and size are recorded with its md5, so
+an instrument is rebuilt only when one of its sources actually
+changed. Nothing is read until an instrument's reference is first used.
+
+    ref = ReferenceIndex(millennium='Z:\\Millennium Set\\Millennium_COMPS_viewonly.xlsx')
+    ref.truth('ChemCam')    # PDS target -> canonical, label, <oxide>_actual
+    ref.labels()            # PDS target -> label, both instruments
+'''
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+OXIDES = ['SiO2','TiO2','Al2O3','FeOT','MgO','CaO','Na2O','K2O','MnO']
+
+#---------#
+# SOURCES #
+#---------#
+
+def read_millennium(path):
+    '''
+    PELLET NAME and oxide columns of the Millennium compositions sheet
+    '''
+    comps = pd.read_excel(path)
+    comps.columns = list(comps.iloc[0])
+    comps = comps.drop(index=[0,1])
+    # FeO in the sheet is total iron
+    comps = comps.rename(columns={'FeO':'FeOT'})
+    oxides = [o for o in OXIDES if o in comps.columns]
+    comps[oxides] = comps[oxides].apply(pd.to_numeric, errors='coerce')
+    return comps[['PELLET NAME'] + oxides].reset_index(drop=True)
+
+def read_ccct_key(path):
+    '''
+    PDS target name, plot label and Millennium PELLET NAME of each ChemCam
+    caltarget (PDS doesn't show Ti metal and only one Graphite spectrum)
+    '''
+    return pd.read_csv(path, header=None, names=['target', 'label', 'canonical'], dtype=str)
+
+def read_scct_key(path):
+    # two title rows above the header
+    return pd.read_excel(path, skiprows=2, dtype={'Index':str})
+
+def read_supercam_cal(path):
+    '''
+    Target_Name and oxide columns of the SuperCam calibration metadata
+    '''
+    cal = pd.read_csv(path)
+    oxides = [o for o in OXIDES if o in cal.columns]
+    return cal[['Target_Name'] + oxides].drop_duplicates()
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+#-------#
+# INDEX #
+#-------#
+
+class ReferenceIndex:
+
+    def __init__(self, path=None, millennium=None, supercam_cal=None,
+                 scct_key=None, ccct_key=None):
+        '''
+        Index kept at path (caltarget_reference.sqlite next to this file
+        by default), built from the given sources. The SCCT and CCCT keys
+        default to the copies in this repo.
+        '''
+        self.path = path or os.path.join(here, 'caltarget_reference.sqlite')
+        self.sources = {
+            'ChemCam':{'millennium':millennium, 'ccct_key':ccct_key or os.path.join(here, 'ccct_key.csv')},
+            'SuperCam':{'supercam_cal':supercam_cal, 'scct_key':scct_key or os.path.join(here, 'SCCT_key.xlsx')}
+        }
+        self.con = None
+        self._loaded = dict()
+
+    def _connect(self):
+        if self.con is None:
+            self.con = sqlite3.connect(self.path)
+            self.con.executescript('''
+                CREATE TABLE IF NOT EXISTS sources (
+                    instrument TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT,
+                    mtime REAL,
+                    size INTEGER,
+                    md5 TEXT NOT NULL,
+                    PRIMARY KEY (instrument, name)
+                );
+                CREATE TABLE IF NOT EXISTS targets (
+                    instrument TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    canonical TEXT,
+                    label TEXT,
+                    description TEXT,
+                    PRIMARY KEY (instrument, target)
+                );
+                CREATE TABLE IF NOT EXISTS compositions (
+                    instrument TEXT NOT NULL,
+                    canonical TEXT NOT NULL,
+                    oxide TEXT NOT NULL,
+                    value REAL,
+                    PRIMARY KEY (instrument, canonical, oxide)
+                );
+            ''')
+        return self.con
+
+    def _stale(self, instrument):
+        '''
+        Current (name, path, mtime, size, md5) of each source and whether
+        any differs from the ones the index was built from
+        '''
+        stored = {r[0]:r[1:] for r in self._connect().execute(
+            'SELECT name, path, mtime, size, md5 FROM sources WHERE instrument = ?', (instrument,))}
+        current = []
+        for name, path in self.sources[instrument].items():
+            if path is None:
+                # not given, use what the index was built from
+                if name not in stored:
+                    raise ValueError(f'No {name} source for the {instrument} reference index')
+                current.append((name, *stored[name]))
+                continue
+            stat = os.stat(path)
+            old = stored.get(name)
+            if old is not None and old[0] == path and old[1] == stat.st_mtime and old[2] == stat.st_size:
+                md5 = old[3]
+            else:
+                # touched or moved, only rebuilt if the bytes changed
+                md5 = file_md5(path)
+            current.append((name, path, stat.st_mtime, stat.st_size, md5))
+
+        stale = any(name not in stored or stored[name][3] != md5 for name, _, _, _, md5 in current)
+        return current, stale
+
+    def _build(self, instrument):
+        sources = self.sources[instrument]
+        if instrument == 'ChemCam':
+            comps = read_millennium(sources['millennium']).rename(columns={'PELLET NAME':'canonical'})
+            targets = read_ccct_key(sources['ccct_key'])
+            targets['description'] = None
+        else:
+            comps = read_supercam_cal(sources['supercam_cal']).rename(columns={'Target_Name':'canonical'})
+            key = read_scct_key(sources['scct_key']).dropna(subset=['Target Name'])
+            targets = pd.DataFrame({'target':key['Target Name'], 'canonical':key['Metadata Name'],
+                                    'label':key['Index'], 'description':key['Description']})
+
+        comps = comps.dropna(subset=['canonical'])
+        conflicting = comps.canonical[comps.canonical.duplicated()].unique()
+        if len(conflicting) > 0:
+            print(f'{instrument} reference: more than one composition for {", ".join(map(str, conflicting))}, the first is kept')
+        comps = comps.drop_duplicates(subset='canonical')
+        comps = comps.melt(id_vars='canonical', var_name='oxide', value_name='value')
+        return targets, comps
+
+    def _ensure(self, instrument):
+        if instrument in self._loaded:
+            return
+        current, stale = self._stale(instrument)
+        con = self._connect()
+        with con:
+            if stale:
+                targets, comps = self._build(instrument)
+                con.execute('DELETE FROM targets WHERE instrument = ?', (instrument,))
+                con.execute('DELETE FROM compositions WHERE instrument = ?', (instrument,))
+                con.execute('DELETE FROM sources WHERE instrument = ?', (instrument,))
+                con.executemany('INSERT INTO targets VALUES (?, ?, ?, ?, ?)',
+                                [(instrument, *[None if pd.isna(v) else str(v) for v in row])
+                                 for row in targets[['target', 'canonical', 'label', 'description']].itertuples(index=False)])
+                con.executemany('INSERT INTO compositions VALUES (?, ?, ?, ?)',
+                                [(instrument, str(c), o, None if pd.isna(v) else float(v))
+                                 for c, o, v in comps.itertuples(index=False)])
+                print(f'{instrument} reference index rebuilt')
+            con.executemany('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?)',
+                            [(instrument, *source) for source in current])
+        self._loaded[instrument] = True
+
+    def targets(self, instrument):
+        '''
+        PDS target name, canonical caltarget, label and description
+        '''
+        self._ensure(instrument)
+        return pd.read_sql_query('SELECT target, canonical, label, description FROM targets WHERE instrument = ?',
+                                 self.con, params=(instrument,))
+
+    def labels(self):
+        '''
+        {PDS target name: label} of both instruments' caltargets (for
+        the instruments with sources given or already indexed)
+        '''
+        labels = dict()
+        for instrument in self.sources:
+            try:
+                targets = self.targets(instrument)
+            except ValueError:
+                continue
+            labels.update(zip(targets.target, targets.label))
+        return labels
+
+    def truth(self, instrument):
+        '''
+        True compositions by PDS target name: canonical, label and
+        <oxide>_actual columns. Targets whose caltarget has no known
+        composition are left out.
+        '''
+        targets = self.targets(instrument)
+        comps = pd.read_sql_query('SELECT canonical, oxide, value FROM compositions WHERE instrument = ?',
+                                  self.con, params=(instrument,))
+        comps = comps.pivot(index='canonical', columns='oxide', values='value')
+        comps = comps[[o for o in OXIDES if o in comps.columns]].add_suffix('_actual')
+        truth = targets.join(comps, on='canonical', how='inner')
+        return truth.drop(columns='description').set_index('target')
+
+    def close(self):
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build or check the caltarget reference index')
+    parser.add_argument('--millennium', help='Millennium compositions .xlsx (ChemCam)')
+    parser.add_argument('--supercam-cal', help='SuperCam calibration metadata .csv')
+    parser.add_argument('--path', help='index file (default caltarget_reference.sqlite here)')
+    args = parser.parse_args()
+
+    ref = ReferenceIndex(args.path, millennium=args.millennium, supercam_cal=args.supercam_cal)
+    for instrument in ref.sources:
+        try:
+            truth = ref.truth(instrument)
+        except ValueError as e:
+            print(e)
+            continue
+        print(f'{instrument}: {len(truth)} caltargets with known compositions')
+    ref.close()
@@ -0,0 +1,232 @@
+import sqlite3
+import argparse
+import numpy as np
+import pandas as pd
+
+import caltarget_accuracy as ca
+
+'''
+Incremental caltarget accuracy statistics
+
+Sufficient statistics of the caltarget observations are kept in SQLite,
+one row per target, sol and oxide: the number of observations, the
+number of predictions with their mean and sum of squared deviations
+(Welford moments), and the number of predictions with a true value with
+their sum of squared errors. Adding observations merges their moments
+into the rows of the sols they fall on, leaving every other row as it
+is, and pkeys already added are skipped (looked up for the incoming
+pkeys only), so the whole metadata table can be passed after each
+refresh.
+
+The tables of caltarget_accuracy are derived from these rows for any
+sol range width, without going back to the observations:
+
+    stats = AccuracyStats('ChemCam_accuracy_stats.sqlite')
+    stats.update(df, comp_cols, 'Target')
+    rmse_results, rmse_summary, pred_true = stats.tables(width=50)
+
+A republished product keeps the values it was first added with; delete
+the file to rebuild from scratch.
+'''
+
+MOMENTS = ['n_obs', 'n', 'mean', 'm2', 'n_err', 'sse']
+
+# values per IN (...) query, older SQLite allows 999 variables a statement
+CHUNK = 500
+
+def combine(stats, keys):
+    '''
+    Pool the moments of the rows of stats within each group of keys
+    (Chan et al.'s parallel form of Welford's update)
+    '''
+    stats = stats.astype({m:'float64' for m in MOMENTS})
+    groups = stats.groupby(keys, sort=False, observed=True)
+    n = groups.n.transform('sum')
+    weighted = (stats.n * stats['mean'].fillna(0)).groupby([stats[k] for k in keys], sort=False, observed=True).transform('sum')
+    mean = (weighted / n).where(n > 0)
+    # each part's squared deviations plus its offset from the pooled mean
+    m2 = stats.m2.fillna(0) + stats.n * (stats['mean'].fillna(0) - mean.fillna(0))**2
+
+    pooled = pd.DataFrame({'n_obs':stats.n_obs, 'n':n, 'mean':mean, 'm2':m2, 'n_err':stats.n_err, 'sse':stats.sse})
+    for k in keys:
+        pooled[k] = stats[k]
+    return pooled.groupby(keys, sort=False, observed=True).agg(
+        {'n_obs':'sum', 'n':'first', 'mean':'first', 'm2':'sum', 'n_err':'sum', 'sse':'sum'}).astype(
+        {'n_obs':'int64', 'n':'int64', 'n_err':'int64'}).reset_index()
+
+def moments(df, comp_cols, target='Target'):
+    '''
+    Moments of a table of observations per target, sol and oxide
+    '''
+    long = df.melt(id_vars=[target, 'sol'], value_vars=comp_cols, var_name='oxide', value_name='pred')
+    actual = df.melt(id_vars=[target, 'sol'], value_vars=[c+'_actual' for c in comp_cols], value_name='actual')
+    long['se'] = (long.pred.to_numpy(dtype='float64') - actual.actual.to_numpy(dtype='float64'))**2
+    long = long.rename(columns={target:'target'})
+
+    groups = long.groupby(['target', 'sol', 'oxide'], sort=False)
+    stats = pd.concat([groups.size().rename('n_obs'),
+                       groups.pred.count().rename('n'),
+                       groups.pred.mean().rename('mean'),
+                       (groups.pred.var(ddof=0) * groups.pred.count()).rename('m2'),
+                       groups.se.count().rename('n_err'),
+                       groups.se.sum().rename('sse')], axis=1)
+    return stats.reset_index()
+
+class AccuracyStats:
+
+    def __init__(self, path):
+        self.path = path
+        self.con = sqlite3.connect(path)
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS stats (
+                target TEXT NOT NULL,
+                sol INTEGER NOT NULL,
+                oxide TEXT NOT NULL,
+                n_obs INTEGER NOT NULL,
+                n INTEGER NOT NULL,
+                mean REAL,
+                m2 REAL NOT NULL,
+                n_err INTEGER NOT NULL,
+                sse REAL NOT NULL,
+                PRIMARY KEY (target, sol, oxide)
+            );
+            CREATE TABLE IF NOT EXISTS actual (
+                target TEXT NOT NULL,
+                oxide TEXT NOT NULL,
+                value REAL,
+                PRIMARY KEY (target, oxide)
+            );
+            CREATE TABLE IF NOT EXISTS seen (
+                pkey TEXT PRIMARY KEY
+            );
+        ''')
+
+    def update(self, df, comp_cols, target='Target'):
+        '''
+        Add the observations in df (pkey, sol, target, <oxide> and
+        <oxide>_actual columns) that haven't been added before. Returns
+        the number added.
+        '''
+        # only the incoming pkeys are looked up
+        df = df.drop_duplicates(subset='pkey')
+        seen = set(r[0] for r in self._select_in('SELECT pkey FROM seen WHERE pkey IN ({})', df.pkey.tolist()))
+        df = df[~df.pkey.isin(seen)]
+        if len(df) == 0:
+            return 0
+
+        new = moments(df, comp_cols, target)
+        sols = [int(s) for s in sorted(new.sol.unique())]
+        old = pd.DataFrame(self._select_in('SELECT * FROM stats WHERE sol IN ({})', sols),
+                           columns=['target', 'sol', 'oxide'] + MOMENTS)
+        # only the rows of the sols touched by new observations are rewritten
+        touched = combine(pd.concat([old, new], ignore_index=True), ['target', 'sol', 'oxide'])
+
+        actual = df.groupby(target)[[c+'_actual' for c in comp_cols]].first()
+        actual.columns = comp_cols
+        actual = actual.reset_index().melt(id_vars=target, var_name='oxide', value_name='value')
+
+        with self.con:
+            self.con.executemany('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                 [(t, int(s), o, int(no), int(n), None if pd.isna(m) else float(m), float(m2), int(ne), float(sse))
+                                  for t, s, o, no, n, m, m2, ne, sse in touched[['target', 'sol', 'oxide'] + MOMENTS].itertuples(index=False)])
+            self.con.executemany('INSERT OR REPLACE INTO actual VALUES (?, ?, ?)',
+                                 [(t, o, None if pd.isna(v) else float(v)) for t, o, v in actual.itertuples(index=False)])
+            self.con.executemany('INSERT INTO seen VALUES (?)', [(p,) for p in df.pkey])
+        return len(df)
+
+    def _select_in(self, query, values):
+        '''
+        Rows of query, whose IN ({}) is filled with values a chunk at a time
+        '''
+        rows = []
+        for start in range(0, len(values), CHUNK):
+            chunk = values[start:start+CHUNK]
+            rows.extend(self.con.execute(query.format(','.join('?'*len(chunk))), chunk))
+        return rows
+
+    def frame(self):
+        return pd.read_sql_query('SELECT * FROM stats ORDER BY target, sol, oxide', self.con)
+
+    def comp_cols(self):
+        # in the order they were first added
+        return [r[0] for r in self.con.execute('SELECT oxide FROM stats GROUP BY oxide ORDER BY MIN(rowid)')]
+
+    def bin_stats(self, width=100, first_sol=None, target='Target'):
+        '''
+        caltarget_accuracy.bin_stats from the stored moments, for sol
+        ranges of width sols from first_sol (default the earliest sol)
+        '''
+        stats = self.frame()
+        comp_cols = self.comp_cols()
+        stats['sol_range'] = ca.sol_ranges(stats.sol, width, first_sol)
+        stats = stats[stats.sol_range.notna()]
+        pooled = combine(stats, ['target', 'sol_range', 'oxide'])
+
+        pooled['RMSE'] = np.sqrt(pooled.sse / pooled.n_err.where(pooled.n_err > 0))
+        pooled['std'] = np.sqrt(pooled.m2 / (pooled.n - 1).where(pooled.n > 1))
+        wide = pooled.pivot(index=['target', 'sol_range'], columns='oxide', values=['RMSE', 'mean', 'std'])
+        wide.columns = [f'{oxide}_{stat}' for stat, oxide in wide.columns]
+        # observations, with or without predictions, as groups.size() in caltarget_accuracy
+        wide.insert(0, 'n', pooled.groupby(['target', 'sol_range'], observed=True).n_obs.max())
+
+        wide = wide[['n'] + [f'{c}_{stat}' for stat in ['RMSE', 'mean', 'std'] for c in comp_cols]].reset_index()
+        wide['sol_range'] = pd.Categorical(wide.sol_range, categories=stats.sol_range.cat.categories, ordered=True)
+        return wide.rename(columns={'target':target}).sort_values([target, 'sol_range'], ignore_index=True)
+
+    def pred_true_summary(self, target='Target'):
+        stats = self.frame()
+        comp_cols = self.comp_cols()
+        pooled = combine(stats, ['target', 'oxide'])
+        pooled['std'] = np.sqrt(pooled.m2 / (pooled.n - 1).where(pooled.n > 1))
+
+        results = pooled.pivot(index='target', columns='oxide', values=['mean', 'std'])
+        results.columns = [f'{oxide}_{stat}' for stat, oxide in results.columns]
+        actual = pd.read_sql_query('SELECT * FROM actual', self.con).pivot(index='target', columns='oxide', values='value')
+        results = results.join(actual[comp_cols].add_suffix('_actual'))
+        results = results[sorted(results.columns)]
+        results.insert(0, 'n_dups', pooled.groupby('target').n_obs.max())
+        results.index.name = target
+        return results.reset_index()
+
+    def tables(self, width=100, first_sol=None, target='Target'):
+        '''
+        RMSE by sol, its summary and the pred/true summary, as
+        caltarget_accuracy.accuracy_tables
+        '''
+        comp_cols = self.comp_cols()
+        rmse_results = ca.rmse_by_sol(self.bin_stats(width, first_sol, target), comp_cols, target)
+        return rmse_results, ca.rmse_summary(rmse_results, comp_cols), self.pred_true_summary(target)
+
+    def close(self):
+        self.con.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Update caltarget accuracy statistics and write the accuracy tables')
+    commands = parser.add_subparsers(dest='instrument', required=True)
+
+    chemcam_parser = commands.add_parser('ChemCam')
+    chemcam_parser.add_argument('meta', help='LIBS_CCS_metadata_w_moc .csv')
+    chemcam_parser.add_argument('comps', help='Millennium compositions .xlsx')
+
+    supercam_parser = commands.add_parser('SuperCam')
+    supercam_parser.add_argument('meta', help='LIBS_RDR_metadata_w_pred_comps .csv')
+    supercam_parser.add_argument('actual', help='SuperCam calibration metadata .csv')
+    supercam_parser.add_argument('key', help='SCCT_key.xlsx')
+
+    for command in [chemcam_parser, supercam_parser]:
+        command.add_argument('--stats', help='statistics file (default <instrument>_accuracy_stats.sqlite)')
+        command.add_argument('--width', type=int, default=100, help='sols per range')
+        command.add_argument('--out', default='', help='folder for the .csv files')
+    args = parser.parse_args()
+
+    if args.instrument == 'ChemCam':
+        df, comp_cols = ca.load_chemcam(args.meta, args.comps)
+    else:
+        df, comp_cols = ca.load_supercam(args.meta, args.actual, args.key)
+
+    stats = AccuracyStats(args.stats or f'{args.instrument}_accuracy_stats.sqlite')
+    added = stats.update(df, comp_cols, ca.TARGET[args.instrument])
+    print(f'{added} new caltarget observations added')
+    ca.write_tables(args.instrument, *stats.tables(args.width, target=ca.TARGET[args.instrument]), args.out)
+    stats.close()
@@ -1,9 +1,24 @@
-import requests
 import re
 from tqdm import tqdm
-import os
 import pandas as pd
 import datetime
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
+
+from pds_download import Downloader
+from pds_cache import ResponseCache
+from pds_manifest import Manifest
+from pds_listing import ListingCache, list_directory
+from spectral_store import SpectralStore, SpectraAccumulator, reference_wave
+from pds_chunks import ChunkedTable
+from pds_pipeline import Pipeline
+from pds_metrics import RunMetrics
+from pds_target_index import write_by_target
+from caltarget_monitor import update_monitor, load_truth, chemcam_bands
+from chemcam_ccs import parse_ccs, read_wave
+from pyhat_export import write_pyhat
+from chemcam_moc import ParsedCache, ingest_moc
+from pds_schema import CHEMCAM_META, join
 
 '''
 by Cai Ytsma (cai@caiconsulting.co.uk)
@@ -11,163 +26,283 @@ last updated 20 April 2023
 
 Automatically extract LIBS CCS data from ChemCam PDS
 
-Information: 
+Information:
 https://pds.nasa.gov/ds-view/pds/viewProfile.jsp?dsid=MSL-M-CHEMCAM-LIBS-4/5-RDR-V1.0
 (MOC based on 'mean' CCS spectra)
 '''
 
-#---------------#
-#  ADD SPECTRA  #
-#---------------#
 # prep
 date = datetime.datetime.now().strftime("%d%m%y")
 
-folder = input('Enter root folder path for data to be saved: ')
-meta_path = f'{folder}\\LIBS_CCS_metadata_{date}.csv'
-spectra_path = f'{folder}\\LIBS_CCS_mean_spectra_{date}.csv'
+# download settings
+n_workers = 8 # concurrent downloads
+per_host = 4 # concurrent requests to the PDS server
+# parse settings
+n_procs = None # parsing processes (None: one per core, 0: parse in this process)
+queue_size = None # downloaded products waiting to be parsed (None: 4 per process)
 
-# get page info
-parent_url = 'https://pds-geosciences.wustl.edu/msl/msl-m-chemcam-libs-4_5-rdr-v1/mslccm_1xxx/data/'
-# get page contents
-page = requests.get(parent_url).text
+# mean spectra are collected in a binary store, the .csv is written once at the end
+store_dtype = 'float64'
+export_csv = True
+# products per checkpoint, a break loses at most this many
+chunk_size = 500
+# attempts in a row without progress before a broken run stops
+max_stalled = 3
+# products sampled for the wavelength axis of a new spectral store
+grid_sample = 5
+
+# JSON report of where the run's time went (LIBS_CCS_run_report_<date>.json),
+# live_metrics also keeps LIBS_CCS_metrics_live.json up to date during the run
+run_report = True
+live_metrics = False
+
+# target-partitioned copy of the metadata with compositions (<name>_by_target.csv and
+# its index), so caltarget analyses read only the rows of the targets and sols they need
+target_index = True
 
-# get sol pages
-sol_pages = list(set(re.findall(r'sol\d{5}', page)))
-sol_page_nos = [int(i[3:]) for i in sol_pages]
-sol_page_nos.sort()
+# caltarget drift monitor, None to skip: a table of the true caltarget compositions
+# (Target and <oxide>_actual columns, e.g. the ChemCam_pred_true_summary.csv written by
+# caltarget_accuracy.py). The RMSE of the last drift_window observations of each
+# caltarget and oxide is checked against the reported RMSEP
+caltarget_truth = None
+drift_window = 20
+drift_alpha = 0.1 # weight of the newest observation in the exponentially weighted RMSE
+
+# get page info (or the path of a local mirror of it)
+parent_url = 'https://pds-geosciences.wustl.edu/msl/msl-m-chemcam-libs-4_5-rdr-v1/mslccm_1xxx/data/'
 
 def no_to_sol(sol_no):
     n_zeros = 5 - len(str(sol_no))
     sol = 'sol'+(n_zeros*'0')+str(sol_no)
     return sol
 
-# find which data needs adding
-def get_sols_to_add():
-    global meta_path, sol_page_nos
-    
-    # if already exists because the run broke
-    if os.path.exists(meta_path):
-        meta = pd.read_csv(meta_path)
-        most_recent_sol_no = max(meta['sol'])
-        sol_to_add = [no_to_sol(i) for i in sol_page_nos if i > most_recent_sol_no]
-        sol_to_add.sort()
-    
-    # to initiate
-    else:
-        meta = pd.DataFrame(columns=['pkey','sol'])
-        sol_to_add = [no_to_sol(i) for i in sol_page_nos]
-        
-    return sol_to_add, meta
-
-sols_to_add, meta = get_sols_to_add()
-
-def make_meta(meta_list):
-    global meta, meta_path
-    meta_to_add = pd.DataFrame(meta_list, columns = ['pkey','sol'])
-    updated_meta = pd.concat([meta,meta_to_add], ignore_index=True).drop_duplicates(ignore_index=True)
-    updated_meta.to_csv(meta_path, index=False)
-    return updated_meta
-
-def make_spectra(spectra_to_add):
-    global spectra_path
-    
+def main(folder, keep_sol=None):
+    '''
+    Refresh the outputs in folder. keep_sol(sol) limits the run to
+    some sols, for a shard of the archive (see pds_shards.py).
+    '''
+    keep_sol = keep_sol or (lambda sol: True)
+
+    #---------------#
+    #  ADD SPECTRA  #
+    #---------------#
+    # unchanged files are served from here instead of being downloaded again
+    cache = ResponseCache(f'{folder}\\PDS cache')
+    dl = Downloader(n_workers=n_workers, per_host=per_host, cache=cache)
+    metrics = RunMetrics(enabled=run_report,
+                         live_path=f'{folder}\\LIBS_CCS_metrics_live.json' if live_metrics else None)
+
+    meta_path = f'{folder}\\LIBS_CCS_metadata_{date}.csv'
+    spectra_path = f'{folder}\\LIBS_CCS_mean_spectra_{date}.csv'
+    store_path = f'{folder}\\LIBS_CCS_mean_spectra_{date}'
+
+    # every product on the sol pages is listed in the manifest, which tracks
+    # what has been ingested into this run's outputs, file by file
+    manifest = Manifest(f'{folder}\\LIBS_CCS_manifest.sqlite')
+    # no collection inventory for this PDS3 volume, the directory pages are read as listings
+    listing_cache = ListingCache(f'{folder}\\LIBS_CCS_listing.json')
+
+    with metrics.stage('listing'):
+        # get sol pages
+        sol_page_nos = [int(n[3:-1]) for n in list_directory(dl, parent_url, listing_cache) if re.match(r'^sol\d{5}/$', n)]
+        sol_page_nos = [i for i in sol_page_nos if keep_sol(i)]
+
+        # sol pages are fetched ahead of the loop on the download pool
+        # (cheap on a refresh, unchanged pages come from the cache)
+        def list_sol(sol):
+            files = list_directory(dl, f'{parent_url}{sol}/', listing_cache)
+            ccs_files = [f for f in files if f.lower().endswith('.csv') and 'ccs_' in f.lower()]
+            return [(f[:-4], int(sol[3:]), f'{parent_url}{sol}/{f}') for f in ccs_files]
+
+        sols_to_list = [no_to_sol(i) for i in sol_page_nos]
+        while len(sols_to_list) > 0:
+            try:
+                for products in tqdm(dl.imap(list_sol, sols_to_list), total=len(sols_to_list), desc='listing sols'):
+                    manifest.add_listing(products, date)
+                sols_to_list = []
+            except OSError:
+                # only relist the sols that didn't make it
+                listed = set(manifest.listed_sols(date))
+                sols_to_list = [no_to_sol(i) for i in sol_page_nos if i not in listed]
+
+    listing_cache.save()
+
+    # find which data needs adding (products that failed earlier today get another go)
+    products_to_add = manifest.todo(date, retry_failed=True)
+
+    # metadata is checkpointed in part files, consolidated into meta_path at the end
+    meta_cols = ['pkey','sol']
+    meta_parts = ChunkedTable(f'{folder}\\LIBS_CCS_metadata_{date}_parts', meta_cols)
+
     # if already exists because the run broke
-    if os.path.exists(spectra_path):
-        global spectra
-        updated_spectra = spectra.merge(spectra_to_add)
-    # to initiate
+    store = SpectralStore(store_path) if SpectralStore.exists(store_path) else None
+
+    # shared ChemCam wavelength axis, the store's or, for a new store, the one most of
+    # a sample of the products are on (so an odd first product doesn't set it)
+    if store is not None:
+        wave = store.wave
+    elif len(products_to_add) > 0:
+        with metrics.stage('wavelength grid'):
+            wave = reference_wave(dl, products_to_add, read_wave, grid_sample)
     else:
-        updated_spectra = spectra_to_add.copy()
-        
-    updated_spectra.to_csv(spectra_path, index=False)
-        
-    return updated_spectra
-
-cont = True if len(sols_to_add) > 0 else False
-
-while cont:
-    try:
-        meta_list = []
-        count=0
-        scount=0
-        for sol in tqdm(sols_to_add, desc='new sols'):
-            sol_page = requests.get(f'{parent_url}{sol}').text
-            ccs_files = list(set(re.findall('.{13}ccs_.{19}\.csv', sol_page)))
-
-            for filename in ccs_files:
-
-                pkey = filename[:-4]
-
-                s = pd.read_csv(f'{parent_url}{sol}/{filename}', 
-                                skiprows=16)
-                s.columns = [c.strip() for c in list(s.columns)]
-
-                if count == 0:
-                    spectra_to_add = s[['# wave','mean']].copy()
-                    spectra_to_add.columns = ['wave', pkey]
-                else:
-                    spectra_to_add[pkey] = s['mean'].values
-
-                meta_list.append([pkey, int(sol[3:])])
-                count+=1 
-            scount+=1 
-
-        # export complete dfs
-        meta = make_meta(meta_list)
-        spectra = make_spectra(spectra_to_add)
-        print(f'{count} spectra from {scount} sols added')
-        cont=False
-
-    except:
-        # export what it got up to
-        meta = make_meta(meta_list)
-        spectra = make_spectra(spectra_to_add)
-        print(f'{count} spectra from {scount} sols added')
-        
-        # prep for next iteration
-        sols_to_add, meta = get_sols_to_add()
-        if len(sols_to_add) == 0:
+        wave = None
+
+    # products are parsed and checked against the axis on the process pool
+    pipeline = Pipeline(dl, partial(parse_ccs, wave=wave), n_procs=n_procs, queue_size=queue_size, metrics=metrics)
+
+    def make_meta(meta_list):
+        meta_parts.write(pd.DataFrame(meta_list, columns=meta_cols))
+
+    def make_spectra(batch):
+        nonlocal store
+
+        # to initiate
+        if store is None:
+            store = SpectralStore(store_path, wave=batch.wave, dtype=store_dtype)
+
+        # appended in bulk, nothing already in the store is rewritten
+        batch.flush(store)
+
+    def export_batch(meta_list, batch, done_list):
+        # products that kept failing go on the failed list, tried again on the next refresh
+        failed = pipeline.take_failed()
+        for (pkey, sol, url), error in failed:
+            print(f'{pkey} set aside: {error}')
+        manifest.mark_failed([product[0] for product, error in failed], date)
+
+        if len(done_list) == 0:
+            return
+        # spectra first, then the metadata part commits the chunk
+        with metrics.stage('store', items=len(done_list)):
+            make_spectra(batch)
+            make_meta(meta_list)
+            # only now are the products safely in the outputs
+            manifest.mark_done(done_list, date)
+        scount = len(set([m[1] for m in meta_list]))
+        print(f'{len(done_list)} spectra from {scount} sols saved')
+
+    cont = True if len(products_to_add) > 0 else False
+    # retries in a row that ingested nothing
+    stalled = 0
+
+    while cont:
+        try:
+            meta_list = []
+            done_list = []
+            batch = SpectraAccumulator(dtype=store_dtype)
+            last_sol = None
+            # downloaded on the I/O threads, parsed on the process pool
+            for (pkey, sol, url), record, mean in tqdm(pipeline.run(products_to_add), total=len(products_to_add), desc='new spectra'):
+
+                # checkpoint whole sols once the chunk is full
+                if len(done_list) >= chunk_size and sol != last_sol:
+                    export_batch(meta_list, batch, done_list)
+                    meta_list = []
+                    done_list = []
+
+                batch.add(pkey, mean, wave=wave)
+                meta_list.append([pkey, sol])
+                done_list.append(record)
+                last_sol = sol
+
+            # export complete dfs
+            export_batch(meta_list, batch, done_list)
+            cont=False
+
+        except OSError as e:
+            # connection or disk trouble, export what it got up to
+            print(f'Interrupted: {e}')
+            export_batch(meta_list, batch, done_list)
+
+            # prep for next iteration, giving up if nothing got through a few times running
+            remaining = manifest.todo(date)
+            stalled = stalled + 1 if len(remaining) == len(products_to_add) else 0
+            if stalled >= max_stalled:
+                raise
+            products_to_add = remaining
+            if len(products_to_add) == 0:
+                cont = False
+
+        except BrokenProcessPool as e:
+            # a parse process died, so the pool takes no more work: export what got
+            # through and put the rest on the failed list for the next refresh
+            print(f'Parse process crashed: {e}')
+            export_batch(meta_list, batch, done_list)
+            manifest.mark_failed([product[0] for product in manifest.todo(date)], date)
             cont = False
-        
-print('Spectra data extracted')
-
-#---------------#
-#    ADD MOC    #
-#---------------#
-moc_outpath = f'{folder}\\moc_composite_{date}.csv'
-
-# get those on the page
-moc_path = parent_url+'moc/'
-moc_page = requests.get(moc_path).text
-moc_files = set(re.findall('moc.{10}\.csv', moc_page))
-
-count=0
-for moc in tqdm(moc_files):
-    df = pd.read_csv(moc_path+moc, skiprows=6)
-
-    # format
-    # remove +/- columns
-    df = df[[c for c in df.columns if '+/-' not in c]]
-    # add pkey column
-    df.insert(0,'pkey',[p[:-4].lower() for p in df.File])
-    # don't need File anymore
-    df.drop(columns='File', inplace=True)
-    df['Source File'] = moc[:-4]
-
-    if count == 0:
-        new_moc = df.copy()
-    else:
-        new_moc = pd.concat([new_moc, df], ignore_index=True)
-    count+=1
-
-# export
-new_moc.to_csv(moc_outpath, index=False)
-    
-print('MOC data extracted')
-    
-#-----------------#
-# ADD MOC TO META #
-#-----------------#
-meta_moc_path = f'{folder}\\LIBS_CCS_metadata_w_moc_{date}.csv'
-meta_moc = meta.merge(new_moc)
-meta_moc.to_csv(meta_moc_path, index=False)
\ No newline at end of file
+
+    pipeline.close()
+
+    new, changed = manifest.whats_new(date)
+    print(f'{len(new)} new and {len(changed)} republished products since the last refresh')
+
+    failed = manifest.failed(date)
+    if len(failed) > 0:
+        failed_path = f'{folder}\\LIBS_CCS_failed_{date}.csv'
+        pd.DataFrame(failed, columns=['pkey','sol','url']).to_csv(failed_path, index=False)
+        print(f'{len(failed)} products could not be ingested, listed in {failed_path}')
+
+    # consolidated outputs, built once
+    # (parts are read as text, then typed)
+    with metrics.stage('consolidate'):
+        meta = meta_parts.consolidate(meta_path, key='pkey', dtype=str, schema=CHEMCAM_META,
+                                      sort_by=['sol', 'pkey'])
+    if export_csv and store is not None:
+        with metrics.stage('spectra csv', items=len(store)):
+            store.to_csv(spectra_path)
+    print('Spectra data extracted')
+
+    #---------------#
+    #    ADD MOC    #
+    #---------------#
+    moc_outpath = f'{folder}\\moc_composite_{date}.csv'
+
+    # fetched concurrently, files unchanged since the last refresh aren't parsed again
+    moc_cache = ParsedCache(f'{folder}\\MOC cache')
+    with metrics.stage('moc'):
+        new_moc = ingest_moc(dl, parent_url+'moc/', moc_cache)
+
+        # export
+        new_moc.to_csv(moc_outpath, index=False)
+
+    print('MOC data extracted')
+
+    #-----------------#
+    # ADD MOC TO META #
+    #-----------------#
+    meta_moc_path = f'{folder}\\LIBS_CCS_metadata_w_moc_{date}.csv'
+    with metrics.stage('moc merge'):
+        meta_moc = join(meta, new_moc)
+        meta_moc.to_csv(meta_moc_path, index=False)
+    if target_index:
+        with metrics.stage('target index'):
+            write_by_target(meta_moc, meta_moc_path, target='Target')
+
+    # caltarget drift, from the observations the monitor hasn't seen yet
+    if caltarget_truth is not None:
+        with metrics.stage('drift monitor'):
+            truth = load_truth(caltarget_truth, 'Target')
+            caltargets = meta_moc[meta_moc.Target.isin(truth.keys())]
+            oxides = [c.split(' ')[0] for c in meta_moc.columns if 'RMSEP' in c]
+            update_monitor(folder, 'LIBS_CCS', date, caltargets, truth, chemcam_bands(caltargets, oxides),
+                           target='Target', window=drift_window, alpha=drift_alpha)
+
+    #-------------------------#
+    # CONVERT TO PYHAT FORMAT #
+    #-------------------------#
+    print('Converting to PyHAT format...')
+
+    # streamed a chunk of rows at a time, meta/comp/wvl groups from the columns
+    if store is not None:
+        with metrics.stage('pyhat export', items=len(meta_moc)):
+            write_pyhat(f'{folder}\\LIBS_CCS_data_PyHAT_{date}.csv', meta_moc, store)
+
+    metrics.report(f'{folder}\\LIBS_CCS_run_report_{date}.json', dl, run=date,
+                   products={'ingested':len(meta), 'failed':len(failed), 'new':len(new), 'changed':len(changed)})
+    manifest.close()
+    dl.close()
+    print('Finished')
+
+# guarded so the parse processes can import this file without running it
+if __name__ == '__main__':
+    main(input('Enter root folder path for data to be saved: '))
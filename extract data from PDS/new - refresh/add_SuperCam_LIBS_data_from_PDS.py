@@ -1,14 +1,26 @@
-from astropy.io import fits
-from astropy.table import Table
-#https://hst-docs.stsci.edu/hstdhb/4-hst-data-analysis/4-4-working-with-fits-data-in-python
-
-import requests
 import re
 from tqdm import tqdm
 import os
 import pandas as pd
-import numpy as np
 import datetime
+import io
+from functools import partial
+from concurrent.futures.process import BrokenProcessPool
+
+from pds_download import Downloader
+from pds_cache import ResponseCache
+from pds_manifest import Manifest
+from pds_listing import ListingCache, list_directory, read_inventory
+from spectral_store import SpectralStore, SpectraAccumulator, reference_wave
+from pds_chunks import ChunkedTable
+from pds_pipeline import Pipeline
+from pds_metrics import RunMetrics
+from pds_target_index import write_by_target
+from caltarget_monitor import update_monitor, load_truth, supercam_bands
+from supercam_fits import process_product, read_wave
+from product_store import ProductStore
+from pyhat_export import write_pyhat
+from pds_schema import SUPERCAM_META, SUPERCAM_COMPS, apply_schema, join
 
 '''
 by Cai Ytsma (cai@caiconsulting.co.uk)
@@ -21,42 +33,56 @@ Data documentation:
 https://pds-geosciences.wustl.edu/m2020/urn-nasa-pds-mars2020_supercam/document/SuperCam_Bundle_SIS.pdf
 '''
 
-# prep 
+# prep
 date = datetime.datetime.now().strftime("%d%m%y")
 
+# (or the path of a local mirror of the collection)
 parent_url = 'https://pds-geosciences.wustl.edu/m2020/urn-nasa-pds-mars2020_supercam/data_calibrated_spectra/'
-
-folder = input('Enter root folder path for data to be saved: ')
-
-# make folders
-laser_folder = f'{folder}\\LIBS RDR laser data'
-spectra_folder = f'{folder}\\LIBS RDR spectra'
-fits_folder = f'{folder}\\LIBS RDR fits files'
-for f in [laser_folder, spectra_folder, fits_folder]:
-    os.makedirs(f, exist_ok=True)
-
-meta_path = f'{folder}\\LIBS_RDR_metadata_{date}.csv'
-meta_comps_path = f'{folder}\\LIBS_RDR_metadata_w_pred_comps_{date}.csv'
-spectra_path = f'{folder}\\LIBS_RDR_mean_spectra_{date}.csv'
-
-# first, update comps file
-comps = pd.read_csv('https://pds-geosciences.wustl.edu/m2020/urn-nasa-pds-mars2020_supercam/data_derived_spectra/supercam_libs_moc.csv')
-comps_path =  f'{folder}\\supercam_libs_moc_{date}.csv'
-comps.to_csv(comps_path, index=False)
-
-# drop header
-comps = comps.iloc[7:].copy()
-comps.columns = list(comps.iloc[0])
-comps.drop(index=7, inplace=True)
-comps.reset_index(inplace=True, drop=True)
-comps.rename(columns={'cdr_fname':'pkey'}, inplace=True)
-# add version 01 to make match meta values
-comps['pkey'] = [x+'01' for x in comps.pkey]
-
-# get page contents
-page = requests.get(parent_url).text
-
-# get sol pages
+comps_url = 'https://pds-geosciences.wustl.edu/m2020/urn-nasa-pds-mars2020_supercam/data_derived_spectra/supercam_libs_moc.csv'
+
+# download settings
+n_workers = 8 # concurrent downloads
+per_host = 4 # concurrent requests to the PDS server
+# parse settings
+n_procs = None # parsing processes (None: one per core, 0: parse in this process)
+queue_size = None # downloaded products waiting to be parsed (None: 4 per process)
+
+# .fits products are parsed in memory, set to True to also keep the raw files
+archive_fits = False
+# per-product laser/spectra tables: 'csv' (a file per product in each folder)
+# or 'hdf5' (a few files partitioned by sol range, needs h5py)
+product_format = 'csv'
+sols_per_file = 100
+
+# mean spectra are collected in a binary store, the .csv is written once at the end
+# ('float32' halves the store, but the .csv values then differ in the last digits)
+store_dtype = 'float64'
+export_csv = True
+# products per checkpoint, a break loses at most this many
+chunk_size = 500
+# attempts in a row without progress before a broken run stops
+max_stalled = 3
+# products sampled for the wavelength grid of a new spectral store
+grid_sample = 5
+
+# JSON report of where the run's time went (LIBS_RDR_run_report_<date>.json),
+# live_metrics also keeps LIBS_RDR_metrics_live.json up to date during the run
+run_report = True
+live_metrics = False
+
+# target-partitioned copy of the metadata with compositions (<name>_by_target.csv and
+# its index), so caltarget analyses read only the rows of the targets and sols they need
+target_index = True
+
+# caltarget drift monitor, None to skip: a table of the true caltarget compositions
+# (target and <oxide>_actual columns, e.g. the SuperCam_pred_true_summary.csv written by
+# caltarget_accuracy.py). The RMSE of the last drift_window observations of each
+# caltarget and oxide is checked against the reported RMSEP
+caltarget_truth = None
+drift_window = 20
+drift_alpha = 0.1 # weight of the newest observation in the exponentially weighted RMSE
+
+# sol of a sol page (sol_00012) or product id (scam_0012_...)
 def get_sol_no(sol_page):
     return int(sol_page.split('_')[1])
 
@@ -65,188 +91,290 @@ def no_to_sol(sol_no):
     sol = 'sol_'+(n_zeros*'0')+str(sol_no)
     return sol
 
-sol_pages = list(set(re.findall(r'sol_\d{5}', page)))
-sol_pages.sort()
-sol_page_nos = [get_sol_no(i) for i in sol_pages]
+def main(folder, keep_sol=None):
+    '''
+    Refresh the outputs in folder. keep_sol(sol) limits the run to
+    some sols, for a shard of the archive (see pds_shards.py).
+    '''
+    keep_sol = keep_sol or (lambda sol: True)
+
+    # unchanged files are served from here instead of being downloaded again
+    cache = ResponseCache(f'{folder}\\PDS cache')
+    dl = Downloader(n_workers=n_workers, per_host=per_host, cache=cache)
+    metrics = RunMetrics(enabled=run_report,
+                         live_path=f'{folder}\\LIBS_RDR_metrics_live.json' if live_metrics else None)
+
+    # make folders
+    laser_folder = f'{folder}\\LIBS RDR laser data'
+    spectra_folder = f'{folder}\\LIBS RDR spectra'
+    fits_folder = f'{folder}\\LIBS RDR fits files'
+    products_folder = f'{folder}\\LIBS RDR products'
+    if archive_fits:
+        os.makedirs(fits_folder, exist_ok=True)
+
+    if product_format == 'hdf5':
+        product_store = ProductStore(products_folder, sols_per_file=sols_per_file)
+    else:
+        product_store = None
+        for f in [laser_folder, spectra_folder]:
+            os.makedirs(f, exist_ok=True)
+
+    meta_path = f'{folder}\\LIBS_RDR_metadata_{date}.csv'
+    meta_comps_path = f'{folder}\\LIBS_RDR_metadata_w_pred_comps_{date}.csv'
+    spectra_path = f'{folder}\\LIBS_RDR_mean_spectra_{date}.csv'
+    store_path = f'{folder}\\LIBS_RDR_mean_spectra_{date}'
+
+    # first, update comps file
+    comps = pd.read_csv(io.BytesIO(dl.get_content(comps_url)))
+    comps_path =  f'{folder}\\supercam_libs_moc_{date}.csv'
+    comps.to_csv(comps_path, index=False)
+
+    # drop header
+    comps = comps.iloc[7:].copy()
+    comps.columns = list(comps.iloc[0])
+    comps.drop(index=7, inplace=True)
+    comps.reset_index(inplace=True, drop=True)
+    comps.rename(columns={'cdr_fname':'pkey'}, inplace=True)
+    # add version 01 to make match meta values
+    comps['pkey'] = [x+'01' for x in comps.pkey]
+    comps = apply_schema(comps, SUPERCAM_COMPS)
+
+    # every product is listed in the manifest, which tracks
+    # what has been ingested into this run's outputs, file by file
+    manifest = Manifest(f'{folder}\\LIBS_RDR_manifest.sqlite')
+    listing_cache = ListingCache(f'{folder}\\LIBS_RDR_listing.json')
+
+    # only LIBS RDR product types
+    def is_libs_rdr(product_id):
+        parts = product_id.split('_')
+        return len(parts) > 4 and re.match('^cl.$', parts[4]) is not None
+
+    with metrics.stage('listing'):
+        try:
+            # the collection inventory lists every product in one file
+            product_ids = [p for p in read_inventory(dl, parent_url, listing_cache) if is_libs_rdr(p) and keep_sol(get_sol_no(p))]
+            manifest.add_listing([(p, get_sol_no(p), f'{parent_url}{no_to_sol(get_sol_no(p))}/{p}.fits') for p in product_ids], date)
+
+        except FileNotFoundError:
+            # no inventory, read the sol directories instead
+            sol_pages = [n[:-1] for n in list_directory(dl, parent_url, listing_cache) if re.match(r'^sol_\d{5}/$', n)]
+            sol_pages = [s for s in sol_pages if keep_sol(get_sol_no(s))]
+
+            # fetched ahead of the loop on the download pool
+            # (cheap on a refresh, unchanged pages come from the cache)
+            def list_sol(sol):
+                files = list_directory(dl, f'{parent_url}{sol}/', listing_cache)
+                return [(f[:-5], get_sol_no(sol), f'{parent_url}{sol}/{f}') for f in files if f.endswith('.fits') and is_libs_rdr(f)]
+
+            sols_to_list = list(sol_pages)
+            while len(sols_to_list) > 0:
+                try:
+                    for products in tqdm(dl.imap(list_sol, sols_to_list), total=len(sols_to_list), desc='listing sols'):
+                        manifest.add_listing(products, date)
+                    sols_to_list = []
+                except OSError:
+                    # only relist the sols that didn't make it
+                    listed = set(manifest.listed_sols(date))
+                    sols_to_list = [i for i in sol_pages if get_sol_no(i) not in listed]
+
+    listing_cache.save()
+
+    # find which data needs adding (products that failed earlier today get another go)
+    products_to_add = manifest.todo(date, retry_failed=True)
+
+    # metadata is checkpointed in part files, consolidated into meta_path at the end
+    meta_cols = ['pkey',
+                 'sol',
+                 'sclock',
+                 'seq_n',
+                 'target',
+                 'location_n',
+                 'producer',
+                 'version']
+    meta_parts = ChunkedTable(f'{folder}\\LIBS_RDR_metadata_{date}_parts', meta_cols)
 
-# find which data needs adding
-def get_sols_to_add():
-    global meta_path, sol_page_nos
-    
     # if already exists because the run broke
-    if os.path.exists(meta_path):
-        meta = pd.read_csv(meta_path)
-        most_recent_sol_no = max(meta['sol'])
-        most_recent_sol = no_to_sol(most_recent_sol_no)
-        sol_to_add = [i for i in sol_pages if i > most_recent_sol]
-        sol_to_add.sort()
-        
-    # to initiate
+    store = SpectralStore(store_path) if SpectralStore.exists(store_path) else None
+
+    # shared SuperCam wavelength grid, the store's or, for a new store, the one most of
+    # a sample of the products are on (so an odd first product doesn't set it)
+    if store is not None:
+        wave = store.wave
+    elif len(products_to_add) > 0:
+        with metrics.stage('wavelength grid'):
+            wave = reference_wave(dl, products_to_add, read_wave, grid_sample)
     else:
-        meta = pd.DataFrame(columns=['pkey',
-                                     'sol',
-                                     'sclock',
-                                     'seq_n',
-                                     'target',
-                                     'location_n',
-                                     'producer',
-                                     'version'])
-        sol_to_add = sol_pages
-        
-    return sol_to_add, meta
-
-sols_to_add, meta = get_sols_to_add()
-
-def make_meta(meta_dict):
-    global meta, meta_path
-    new_meta = pd.DataFrame.from_dict(meta_dict, orient='index').reset_index()
-    new_meta.columns = list(meta.columns)
-    updated_meta = pd.concat([meta,new_meta], ignore_index=True).drop_duplicates(ignore_index=True)
-    updated_meta.to_csv(meta_path, index=False)
-    return updated_meta
-
-def make_spectra(spectra_to_add):
-    global spectra_path
-    
-    # if already exists because the run broke
-    if os.path.exists(spectra_path):
-        global spectra
-        updated_spectra = spectra.merge(spectra_to_add, on='wave')
-    
-    # to initiate
+        wave = None
+
+    # products are parsed, checked against the grid (and their .csv files written) on the process pool
+    if product_store is not None:
+        parse = partial(process_product, wave=wave,
+                        fits_folder=fits_folder if archive_fits else None)
     else:
-        updated_spectra = spectra_to_add.copy()
-    
-    updated_spectra.to_csv(spectra_path, index=False)
-    return updated_spectra
-
-cont = True if len(sols_to_add) > 0 else False
-    
-while cont:
-    try:
-        meta_dict = dict()
-        spectra_dict = dict()
-        count=0
-        scount=0
-        for sol in tqdm(sols_to_add, desc='new sols'):
-
-            sol_page = requests.get(parent_url+sol).text
-            fits_files = list(set(re.findall('.{65}\.fits', sol_page)))
-
-            for filename in fits_files:
-
-                # get product type
-                prod_type = filename.split('_')[4]
-
-                # continue if LIBS RDR type
-                if re.match('^cl.$', prod_type):
-                    
-                    pkey = filename[:-5]
-
-                    # download file
-                    data = requests.get(f'{parent_url}{sol}/{filename}').content
-                    with open(f'{fits_folder}\\{filename}', 'wb') as file:
-                        file.write(data)
-                        file.close()
-
-                    data = fits.open(f'{fits_folder}\\{filename}')
-
-                    # laser data
-                    laser = pd.DataFrame(data[5].data)
-                    for col in laser.columns:
-                        laser[col] = laser[col].astype('float64')
-                    laser.to_csv(f'{laser_folder}\\{filename[:-5]}.csv', index=False)
-
-                    # spectral data
-                    s = pd.DataFrame(data[6].data)  
-                    for col in s.columns:
-                        s[col] = s[col].astype('float64')
-
-                    stats = pd.DataFrame(data[7].data)  
-                    for col in stats.columns:
-                        stats[col] = stats[col].astype('float64')
-
-                    wave = pd.DataFrame(data[8].data)
-                    for col in wave.columns:
-                        wave[col] = wave[col].astype('float64')
-
-                    saturation = pd.DataFrame(data[9].data)
-
-                    # merge
-                    big_df = wave.join(stats).join(s).join(saturation)
-                    big_df.to_csv(f'{spectra_folder}\\{pkey}.csv', index=False)
-                    
-                    # get mean spectrum to add to spectra file
-                    if count==0:
-                        spectra_to_add = big_df[['Wavelength','Mean']].copy()
-                        spectra_to_add.columns = ['wave',pkey]
-                    else:
-                        spectra_to_add[pkey] = list(big_df['Mean'].values)
-
-                    # add metadata
-                    info = pkey.split('_')
-                    meta_dict[pkey] = {   
-                        'sol':info[1],
-                        'sclock':'_'.join(info[2:4]),
-                        'seq_n':info[5],
-                        'target':filename[39:60].replace('_',' ').strip(),
-                        'point_n':filename[60:62],
-                        'producer':filename[62],
-                        'version':filename[63:65]
-                    }
-
-                    count+=1
-
-                # wrong file type
-                else:
-                    continue
-                    
-            scount+=1
-
-        # export complete dfs
-        meta = make_meta(meta_dict)
-        spectra = make_spectra(spectra_to_add)
-        print(f'{count} spectra from {scount} sols added')
-        cont=False
-
-    except:
-        meta = make_meta(meta_dict)
-        spectra = make_spectra(spectra_to_add)
-        print(f'{count} spectra from {scount} sols added')
-        
-        # prep for next iteration
-        sols_to_add, meta = get_sols_to_add()
-        if len(sols_to_add) == 0:
+        parse = partial(process_product, wave=wave,
+                        laser_folder=laser_folder,
+                        spectra_folder=spectra_folder,
+                        fits_folder=fits_folder if archive_fits else None)
+    pipeline = Pipeline(dl, parse, n_procs=n_procs, queue_size=queue_size, metrics=metrics)
+
+    def make_meta(meta_dict):
+        new_meta = pd.DataFrame.from_dict(meta_dict, orient='index').reset_index()
+        new_meta.columns = meta_cols
+        meta_parts.write(new_meta)
+
+    def make_spectra(batch):
+        nonlocal store
+
+        # to initiate
+        if store is None:
+            store = SpectralStore(store_path, wave=batch.wave, dtype=store_dtype)
+
+        # appended in bulk, nothing already in the store is rewritten
+        batch.flush(store)
+
+    def export_batch(meta_dict, batch, done_list):
+        # products that kept failing go on the failed list, tried again on the next refresh
+        failed = pipeline.take_failed()
+        for (pkey, sol, url), error in failed:
+            print(f'{pkey} set aside: {error}')
+        manifest.mark_failed([product[0] for product, error in failed], date)
+
+        if len(done_list) == 0:
+            return
+        # spectra and product tables first, then the metadata part commits the chunk
+        with metrics.stage('store', items=len(done_list)):
+            make_spectra(batch)
+            if product_store is not None:
+                product_store.flush()
+            make_meta(meta_dict)
+            # only now are the products safely in the outputs
+            manifest.mark_done(done_list, date)
+        scount = len(set([m['sol'] for m in meta_dict.values()]))
+        print(f'{len(done_list)} spectra from {scount} sols saved')
+
+    cont = True if len(products_to_add) > 0 else False
+    # retries in a row that ingested nothing
+    stalled = 0
+
+    while cont:
+        try:
+            meta_dict = dict()
+            done_list = []
+            batch = SpectraAccumulator(dtype=store_dtype)
+            last_sol = None
+            # downloaded on the I/O threads, parsed on the process pool
+            for (pkey, sol, url), record, (mean, tables) in tqdm(pipeline.run(products_to_add), total=len(products_to_add), desc='new spectra'):
+
+                # checkpoint whole sols once the chunk is full
+                if len(done_list) >= chunk_size and sol != last_sol:
+                    export_batch(meta_dict, batch, done_list)
+                    meta_dict = dict()
+                    done_list = []
+
+                # get mean spectrum to add to spectra file
+                batch.add(pkey, mean, wave=wave)
+
+                # laser and spectra tables
+                if product_store is not None:
+                    with metrics.stage('product store', items=1, sol=sol):
+                        product_store.write(pkey, sol, tables)
+
+                # add metadata
+                filename = url.split('/')[-1]
+                info = pkey.split('_')
+                meta_dict[pkey] = {
+                    'sol':info[1],
+                    'sclock':'_'.join(info[2:4]),
+                    'seq_n':info[5],
+                    'target':filename[39:60].replace('_',' ').strip(),
+                    'point_n':filename[60:62],
+                    'producer':filename[62],
+                    'version':filename[63:65]
+                }
+
+                done_list.append(record)
+                last_sol = sol
+
+            # export complete dfs
+            export_batch(meta_dict, batch, done_list)
+            cont=False
+
+        except OSError as e:
+            # connection or disk trouble, export what it got up to
+            print(f'Interrupted: {e}')
+            export_batch(meta_dict, batch, done_list)
+
+            # prep for next iteration, giving up if nothing got through a few times running
+            remaining = manifest.todo(date)
+            stalled = stalled + 1 if len(remaining) == len(products_to_add) else 0
+            if stalled >= max_stalled:
+                raise
+            products_to_add = remaining
+            if len(products_to_add) == 0:
+                cont = False
+
+        except BrokenProcessPool as e:
+            # a parse process died, so the pool takes no more work: export what got
+            # through and put the rest on the failed list for the next refresh
+            print(f'Parse process crashed: {e}')
+            export_batch(meta_dict, batch, done_list)
+            manifest.mark_failed([product[0] for product in manifest.todo(date)], date)
             cont = False
 
-print('Spectra data extracted')
-
-# finally, add predicted compositions
-meta_w_comps = meta.merge(comps)
-meta_w_comps.to_csv(meta_comps_path, index=False)
-
-#-------------------------#
-# CONVERT TO PYHAT FORMAT #
-#-------------------------#
-print('Converting to PyHAT format...')
-
-# prepare spectra
-spectra = spectra.T.reset_index()
-spectra.columns = list(spectra.iloc[0])
-spectra.drop(index=0, inplace=True)
-spectra.rename(columns={'wave':'pkey'}, inplace=True)
-if np.nan in spectra.columns:
-    spectra.drop(columns=np.nan, inplace=True)
-    
-# merge with metadata
-big_df = meta_w_comps.merge(spectra)
-
-# add column labels needed for PyHAT
-col_list = list(big_df.columns)
-new_cols = ['meta']*8 + ['comp']*19 + ['wvl']*7462
-col_df = pd.DataFrame([new_cols, col_list], columns=col_list)
-big_df = pd.concat([col_df, big_df])
-
-# export
-big_df.to_csv(f'{folder}\\LIBS_RDR_data_PyHAT_{date}.csv', index=False, header=False)
-print('Finished')
\ No newline at end of file
+    pipeline.close()
+    if product_store is not None:
+        product_store.close()
+
+    new, changed = manifest.whats_new(date)
+    print(f'{len(new)} new and {len(changed)} republished products since the last refresh')
+
+    failed = manifest.failed(date)
+    if len(failed) > 0:
+        failed_path = f'{folder}\\LIBS_RDR_failed_{date}.csv'
+        pd.DataFrame(failed, columns=['pkey','sol','url']).to_csv(failed_path, index=False)
+        print(f'{len(failed)} products could not be ingested, listed in {failed_path}')
+
+    # consolidated outputs, built once
+    # (parts are read as text, then typed, so sol '0012' becomes 12)
+    with metrics.stage('consolidate'):
+        meta = meta_parts.consolidate(meta_path, key='pkey', dtype=str, schema=SUPERCAM_META,
+                                      sort_by=['sol', 'pkey'])
+    if export_csv and store is not None:
+        with metrics.stage('spectra csv', items=len(store)):
+            store.to_csv(spectra_path)
+    print('Spectra data extracted')
+
+    # finally, add predicted compositions
+    with metrics.stage('comps merge'):
+        meta_w_comps = join(meta, comps)
+        meta_w_comps.to_csv(meta_comps_path, index=False)
+    if target_index:
+        with metrics.stage('target index'):
+            write_by_target(meta_w_comps, meta_comps_path, target='target')
+
+    # caltarget drift, from the observations the monitor hasn't seen yet
+    if caltarget_truth is not None:
+        with metrics.stage('drift monitor'):
+            update_monitor(folder, 'LIBS_RDR', date, meta_w_comps[meta_w_comps.target.str.contains('scct')],
+                           load_truth(caltarget_truth, 'target'), supercam_bands(comps_path),
+                           target='target', window=drift_window, alpha=drift_alpha)
+
+    #-------------------------#
+    # CONVERT TO PYHAT FORMAT #
+    #-------------------------#
+    print('Converting to PyHAT format...')
+
+    # streamed a chunk of rows at a time, meta/comp/wvl groups from the columns
+    if store is not None:
+        with metrics.stage('pyhat export', items=len(meta_w_comps)):
+            write_pyhat(f'{folder}\\LIBS_RDR_data_PyHAT_{date}.csv', meta_w_comps, store)
+
+    metrics.report(f'{folder}\\LIBS_RDR_run_report_{date}.json', dl, run=date,
+                   products={'ingested':len(meta), 'failed':len(failed), 'new':len(new), 'changed':len(changed)})
+    manifest.close()
+    dl.close()
+    print('Finished')
+
+# guarded so the parse processes can import this file without running it
+if __name__ == '__main__':
+    main(input('Enter root folder path for data to be saved: '))
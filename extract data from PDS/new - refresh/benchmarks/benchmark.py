@@ -0,0 +1,181 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+
+import mock_pds
+
+'''
+Throughput benchmarks for the PDS ingest scripts and exports
+
+Builds a mock PDS tree (mock_pds.py) with n fake sols, serves it
+locally with the given latency and bandwidth and runs each ingest
+script against it twice: a cold run (nothing cached) and a refresh
+(a new run date, every file answered from the response cache). Each
+run reports products/s, MB/s received over the network (the
+downloader's byte count from the run report, so a refresh answered
+from the cache moves next to nothing), the peak RSS of the ingest
+process and the largest peak RSS of its parse worker processes. The
+PyHAT export is timed on a synthetic spectral store of --rows spectra,
+and the caltarget accuracy tables (caltarget_accuracy.py) on
+--accuracy-rows synthetic observations.
+
+    python benchmark.py --sols 50 --latency 0.02 --bandwidth 20 --json results.json
+'''
+
+code = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, code)
+# the accuracy analysis lives with the notebooks at the top of the repo
+sys.path.insert(0, os.path.abspath(os.path.join(code, '..', '..')))
+
+SCRIPTS = {
+    'ChemCam':('add_ChemCam_LIBS_data_from_PDS', 'LIBS_CCS'),
+    'SuperCam':('add_SuperCam_LIBS_data_from_PDS', 'LIBS_RDR')
+}
+
+# runs one ingest in its own process, pointed at the mock server
+RUNNER = '''
+import sys, json, multiprocessing
+sys.path.insert(0, {code!r})
+import {module} as script
+script.parent_url = script.parent_url.replace('https://pds-geosciences.wustl.edu', {server!r})
+if hasattr(script, 'comps_url'):
+    script.comps_url = script.comps_url.replace('https://pds-geosciences.wustl.edu', {server!r})
+script.date = {date!r}
+script.run_report = True
+script.main({folder!r})
+# the parse pool is shut down without waiting, workers only count once reaped
+for worker in multiprocessing.active_children():
+    worker.join()
+try:
+    import resource
+    scale = 1e6 if sys.platform == 'darwin' else 1e3
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    # largest of the (reaped) worker processes
+    peak_workers = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+except ImportError:
+    # no resource module on Windows
+    peak = peak_workers = None
+print(json.dumps({{'peak_rss_mb':peak, 'peak_worker_rss_mb':peak_workers}}))
+'''
+
+def bench_ingest(instrument, server, folder, date):
+    module, prefix = SCRIPTS[instrument]
+    runner = RUNNER.format(code=code, module=module, server=server, date=date, folder=folder)
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', runner], capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'{instrument} ingest failed:\n{result.stderr[-2000:]}')
+    memory = json.loads(result.stdout.strip().split('\n')[-1])
+
+    con = sqlite3.connect(f'{folder}\\{prefix}_manifest.sqlite')
+    n = con.execute("SELECT COUNT(*) FROM products WHERE status = 'done' AND run = ?", (date,)).fetchone()[0]
+    con.close()
+    with open(f'{folder}\\{prefix}_run_report_{date}.json') as f:
+        received = json.load(f)['downloads']['bytes']
+    return {
+        'benchmark':f'{instrument} ingest ({date})',
+        'seconds':round(wall, 2),
+        'items':n,
+        'items_per_s':round(n / wall, 2),
+        'mb_per_s':round(received / 1e6 / wall, 2),
+        'peak_rss_mb':round(memory['peak_rss_mb'], 1) if memory['peak_rss_mb'] is not None else None,
+        'peak_worker_rss_mb':round(memory['peak_worker_rss_mb'], 1) if memory['peak_worker_rss_mb'] is not None else None
+    }
+
+def bench_pyhat(folder, rows, channels=7933):
+    from spectral_store import SpectralStore
+    from pyhat_export import write_pyhat
+
+    rng = np.random.default_rng(0)
+    pkeys = [f'scam_{i:04d}_product' for i in range(rows)]
+    store = SpectralStore(os.path.join(folder, 'pyhat_store'), wave=np.linspace(240, 850, channels))
+    for start in range(0, rows, 1000):
+        block = pkeys[start:start+1000]
+        store.append(block, rng.random((len(block), channels), dtype='float32') * 1e11)
+    table = pd.DataFrame({'pkey':pkeys, 'sol':np.arange(rows) // 20, 'target':'scct basalt'})
+    for oxide in mock_pds.OXIDES:
+        table[oxide] = rng.random(rows) * 50
+
+    path = os.path.join(folder, 'pyhat.csv')
+    start = time.perf_counter()
+    write_pyhat(path, table, store)
+    wall = time.perf_counter() - start
+    return {
+        'benchmark':'PyHAT export',
+        'seconds':round(wall, 2),
+        'items':rows,
+        'items_per_s':round(rows / wall, 2),
+        'mb_per_s':round(os.path.getsize(path) / 1e6 / wall, 2)
+    }
+
+def bench_accuracy(rows, n_targets=20, n_sols=4000):
+    import caltarget_accuracy
+
+    rng = np.random.default_rng(0)
+    targets = rng.integers(0, n_targets, rows)
+    actual = rng.random((n_targets, len(mock_pds.OXIDES))) * 50
+    df = pd.DataFrame(actual[targets] + rng.normal(0, 2, (rows, len(mock_pds.OXIDES))), columns=mock_pds.OXIDES)
+    df.insert(0, 'Target', [f'target {t}' for t in targets])
+    df.insert(1, 'sol', rng.integers(0, n_sols, rows))
+    for i, oxide in enumerate(mock_pds.OXIDES):
+        df[oxide+'_actual'] = actual[targets, i]
+
+    start = time.perf_counter()
+    caltarget_accuracy.accuracy_tables(df, mock_pds.OXIDES)
+    wall = time.perf_counter() - start
+    return {
+        'benchmark':'caltarget accuracy',
+        'seconds':round(wall, 2),
+        'items':rows,
+        'items_per_s':round(rows / wall, 2)
+    }
+
+def main(sols=20, latency=0, bandwidth=None, rows=2000, port=8766, instruments=('ChemCam', 'SuperCam'), accuracy_rows=100000):
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tree = os.path.join(tmp, 'tree')
+        mock_pds.build(tree, sols)
+        server = mock_pds.serve(tree, port, latency, bandwidth, background=True)
+        try:
+            for instrument in instruments:
+                folder = os.path.join(tmp, instrument)
+                for date in ['cold', 'refresh']:
+                    results.append(bench_ingest(instrument, f'http://localhost:{port}', folder, date))
+                    print(results[-1])
+        finally:
+            server.shutdown()
+
+        if rows > 0:
+            results.append(bench_pyhat(tmp, rows))
+            print(results[-1])
+    if accuracy_rows > 0:
+        results.append(bench_accuracy(accuracy_rows))
+        print(results[-1])
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the PDS ingest scripts against a local mock archive')
+    parser.add_argument('--sols', type=int, default=20, help='fake sols in the mock archive')
+    parser.add_argument('--latency', type=float, default=0, help='seconds per request')
+    parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per connection')
+    parser.add_argument('--rows', type=int, default=2000, help='spectra in the PyHAT export benchmark (0 to skip)')
+    parser.add_argument('--accuracy-rows', type=int, default=100000, help='observations in the caltarget accuracy benchmark (0 to skip)')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--instruments', nargs='+', default=['ChemCam', 'SuperCam'], choices=list(SCRIPTS))
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    results = main(args.sols, args.latency, args.bandwidth, args.rows, args.port, args.instruments, args.accuracy_rows)
+    print(pd.DataFrame(results).to_string(index=False))
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,166 @@
+import os
+import time
+import shutil
+import argparse
+import functools
+import threading
+import numpy as np
+import pandas as pd
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+Local mock of the PDS archive for benchmarking the ingest scripts
+
+build() lays out a synthetic copy of the ChemCam and SuperCam trees the
+scripts read, made from the sample files in "original - append":
+    msl/.../data/sol<NNNNN>/<ccs>.csv and data/moc/moc_*.csv
+    m2020/.../data_calibrated_spectra/sol_<NNNNN>/<product>.fits
+    m2020/.../data_derived_spectra/supercam_libs_moc.csv
+with n_sols fake sols. serve() serves it over HTTP, with optional
+latency per request and bandwidth per connection to stand in for the
+real server.
+
+    python mock_pds.py build <folder> --sols 50
+    python mock_pds.py serve <folder> --port 8766 --latency 0.05 --bandwidth 20
+'''
+
+samples = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'original - append')
+
+CHEMCAM = 'msl/msl-m-chemcam-libs-4_5-rdr-v1/mslccm_1xxx/data'
+SUPERCAM = 'm2020/urn-nasa-pds-mars2020_supercam'
+
+OXIDES = ['SiO2','TiO2','Al2O3','FeOT','MgO','CaO','Na2O','K2O']
+
+def _link(source, path):
+    # the same bytes for every product, hard links save the disk space where possible
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copy(source, path)
+
+def build_chemcam(root, n_sols, first_sol=13):
+    data = os.path.join(root, CHEMCAM)
+    os.makedirs(os.path.join(data, 'moc'), exist_ok=True)
+    spectra = pd.read_csv(os.path.join(samples, 'ChemCam_initial_files', 'LIBS_CCS_mean_spectra.csv'))
+    moc = pd.read_csv(os.path.join(samples, 'ChemCam_initial_files', 'moc_composite.csv'))
+
+    moc_rows = []
+    for k in range(n_sols):
+        sol = first_sol + k
+        folder = os.path.join(data, f'sol{sol:05d}')
+        os.makedirs(folder, exist_ok=True)
+        for j, pkey in enumerate(spectra.columns[1:]):
+            # a new spacecraft clock per sol, the rest of the name as in the sample
+            new_pkey = pkey[:4] + f'{398645626+k*1000:09d}' + pkey[13:]
+            with open(os.path.join(folder, f'{new_pkey}.csv'), 'w') as f:
+                for i in range(16):
+                    f.write(f'# header line {i}\n')
+                f.write('# wave, mean, median\n')
+                f.write(''.join(f'{w}, {m}, {m}\n' for w, m in zip(spectra.wave, spectra[pkey])))
+            row = moc.iloc[j % len(moc)].copy()
+            row['pkey'] = new_pkey
+            moc_rows.append(row)
+
+    moc = pd.DataFrame(moc_rows).drop(columns='Source File')
+    moc.insert(0, 'File', [p.upper()+'.CSV' for p in moc.pkey])
+    moc = moc.drop(columns='pkey')
+    per_file = 500
+    for i, start in enumerate(range(0, len(moc), per_file)):
+        with open(os.path.join(data, 'moc', f'moc_{i:04d}_{i+89:04d}.csv'), 'w') as f:
+            for j in range(6):
+                f.write(f'header {j}\n')
+            moc.iloc[start:start+per_file].to_csv(f, index=False)
+
+def build_supercam(root, n_sols, first_sol=12, inventory=True):
+    collection = os.path.join(root, SUPERCAM, 'data_calibrated_spectra')
+    derived = os.path.join(root, SUPERCAM, 'data_derived_spectra')
+    os.makedirs(derived, exist_ok=True)
+    fits_folder = os.path.join(samples, 'SuperCam_initial_files', 'LIBS RDR fits files')
+    source = os.path.join(fits_folder, sorted(os.listdir(fits_folder))[0])
+
+    names = []
+    for k in range(n_sols):
+        sol = first_sol + k
+        folder = os.path.join(collection, f'sol_{sol:05d}')
+        os.makedirs(folder, exist_ok=True)
+        for i, target in enumerate(['scct_basalt', 'maaz']):
+            # 65 character product names, target padded as in PDS
+            name = f'scam_{sol:04d}_0668002890_477_cl{i+1}_scam15210_' + target.ljust(21, '_') + '01p01'
+            _link(source, os.path.join(folder, f'{name}.fits'))
+            names.append(name)
+
+    if inventory:
+        with open(os.path.join(collection, 'collection_data_calibrated_spectra_inventory.csv'), 'w') as f:
+            f.write(''.join(f'P,urn:nasa:pds:mars2020_supercam:data_calibrated_spectra:{n}::1.0\r\n' for n in names))
+
+    # predicted compositions, with the 7 summary rows above the table as in PDS
+    rng = np.random.default_rng(0)
+    columns = OXIDES + [o+'_stdev' for o in OXIDES]
+    rows = [[label]+list(np.round(rng.random(len(columns))*5, 2))
+            for label in ['Min','Q1','Median','Q3','Max','RMSEP','blank']]
+    rows.append(['cdr_fname']+columns)
+    rows += [[n[:-2]]+list(np.round(rng.random(len(columns))*50, 2)) for n in names]
+    pd.DataFrame(rows, columns=['Training set Quartiles']+columns).to_csv(
+        os.path.join(derived, 'supercam_libs_moc.csv'), index=False)
+
+def build(root, n_sols, inventory=True):
+    build_chemcam(root, n_sols)
+    build_supercam(root, n_sols, inventory=inventory)
+
+
+class SlowHandler(SimpleHTTPRequestHandler):
+    latency = 0 # seconds before each response
+    bandwidth = None # bytes per second per connection
+
+    def send_head(self):
+        time.sleep(self.latency)
+        return super().send_head()
+
+    def copyfile(self, source, outputfile):
+        if not self.bandwidth:
+            return super().copyfile(source, outputfile)
+        block = 64*1024
+        while True:
+            data = source.read(block)
+            if not data:
+                break
+            outputfile.write(data)
+            time.sleep(len(data) / self.bandwidth)
+
+    def log_message(self, *args):
+        pass
+
+def serve(root, port=8766, latency=0, bandwidth=None, background=False):
+    '''
+    Serve root over HTTP. bandwidth is in MB/s. With background, the
+    server runs on a thread and is returned (call .shutdown() to stop).
+    '''
+    handler = type('Handler', (SlowHandler,), {'latency':latency,
+                                               'bandwidth':bandwidth*1e6 if bandwidth else None})
+    server = ThreadingHTTPServer(('localhost', port), functools.partial(handler, directory=root))
+    server.daemon_threads = True
+    if background:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+    print(f'Serving {root} on http://localhost:{port}/')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local mock PDS archive')
+    commands = parser.add_subparsers(dest='command', required=True)
+    build_parser = commands.add_parser('build')
+    build_parser.add_argument('folder')
+    build_parser.add_argument('--sols', type=int, default=50)
+    build_parser.add_argument('--no-inventory', action='store_true')
+    serve_parser = commands.add_parser('serve')
+    serve_parser.add_argument('folder')
+    serve_parser.add_argument('--port', type=int, default=8766)
+    serve_parser.add_argument('--latency', type=float, default=0, help='seconds per request')
+    serve_parser.add_argument('--bandwidth', type=float, default=None, help='MB/s per connection')
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        build(args.folder, args.sols, inventory=not args.no_inventory)
+    else:
+        serve(args.folder, args.port, args.latency, args.bandwidth)
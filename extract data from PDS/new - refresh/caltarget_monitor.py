@@ -0,0 +1,191 @@
+import os
+import math
+import pickle
+from collections import deque
+import pandas as pd
+
+'''
+Caltarget drift monitor for the PDS ingest scripts
+
+Each caltarget observation that comes out of an ingest (a row of the
+metadata with predicted compositions, for a target with a known true
+composition) updates, per target and oxide, the squared error over a
+window of the last few observations and an exponentially weighted
+mean of it, in constant time. When the RMSE over the window leaves the
+band of the reported RMSEP, or comes back into it, an alert is raised.
+
+Reported RMSEP bands:
+    ChemCam   mean of the '<oxide> RMSEP' column +/- half its std, as
+              the band drawn in the accuracy notebook
+    SuperCam  up to the RMSEP row of supercam_libs_moc.csv
+
+The monitor is kept in a .pkl between refreshes, with the pkeys it has
+seen, so each refresh only feeds it the new observations.
+'''
+
+class ErrorWindow:
+    '''
+    Squared errors of one target and oxide
+    '''
+
+    def __init__(self, window, alpha):
+        self.errors = deque(maxlen=window)
+        self.alpha = alpha
+        self.total = 0.0
+        self.ewma = None
+        self.n = 0
+        self.state = 'ok'
+
+    def add(self, se):
+        if len(self.errors) == self.errors.maxlen:
+            self.total -= self.errors[0]
+        self.errors.append(se)
+        self.total += se
+        self.ewma = se if self.ewma is None else self.alpha*se + (1-self.alpha)*self.ewma
+        self.n += 1
+
+    def rmse(self):
+        return math.sqrt(max(self.total, 0) / len(self.errors))
+
+    def ewma_rmse(self):
+        return math.sqrt(self.ewma)
+
+class DriftMonitor:
+
+    def __init__(self, truth, bands, window=20, alpha=0.1, min_obs=5):
+        '''
+        truth: {target: {oxide: true value}}
+        bands: {oxide: (low, high)} reported RMSEP band
+        Alerts need at least min_obs observations in the window (or a full window).
+        '''
+        self.truth = truth
+        self.bands = bands
+        self.window = window
+        self.alpha = alpha
+        self.min_obs = min_obs
+        self.errors = dict()
+        self.seen = set()
+
+    @classmethod
+    def load(cls, path, truth, bands, **settings):
+        '''
+        The monitor saved at path (with the current truth and bands), or a new one
+        '''
+        if not os.path.exists(path):
+            return cls(truth, bands, **settings)
+        with open(path, 'rb') as f:
+            monitor = pickle.load(f)
+        monitor.truth = truth
+        monitor.bands = bands
+        return monitor
+
+    def save(self, path):
+        tmp_path = path+'.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(self, f)
+        os.replace(tmp_path, path)
+
+    def observe(self, pkey, sol, target, predicted):
+        '''
+        Add one observation (predicted: {oxide: value}), returns its alerts
+        '''
+        if pkey in self.seen or target not in self.truth:
+            return []
+        self.seen.add(pkey)
+
+        alerts = []
+        for oxide, (low, high) in self.bands.items():
+            actual = self.truth[target].get(oxide)
+            pred = predicted.get(oxide)
+            if actual is None or pred is None or pd.isna(actual) or pd.isna(pred):
+                continue
+            errors = self.errors.get((target, oxide))
+            if errors is None:
+                errors = self.errors[(target, oxide)] = ErrorWindow(self.window, self.alpha)
+            errors.add((pred - actual)**2)
+            if len(errors.errors) < min(self.min_obs, self.window):
+                continue
+
+            rmse = errors.rmse()
+            state = 'above' if rmse > high else 'below' if rmse < low else 'ok'
+            # alert on the change, not on every observation outside the band
+            if state != errors.state:
+                errors.state = state
+                alerts.append([sol, pkey, target, oxide, rmse, errors.ewma_rmse(), low, high,
+                               'back in band' if state == 'ok' else f'{state} RMSEP band'])
+        return alerts
+
+    def observe_table(self, df, target='target'):
+        '''
+        Add the rows of df (pkey, sol, target and oxide columns) in sol order,
+        returns the alerts as a DataFrame
+        '''
+        oxides = [o for o in self.bands if o in df.columns]
+        df = df[df[target].isin(self.truth.keys()) & ~df.pkey.isin(self.seen)].sort_values(['sol', 'pkey'])
+        alerts = []
+        for row in df[['pkey', 'sol', target] + oxides].itertuples(index=False):
+            alerts += self.observe(row[0], row[1], row[2], dict(zip(oxides, row[3:])))
+        return pd.DataFrame(alerts, columns=['sol', 'pkey', 'target', 'oxide', 'window_RMSE', 'ewma_RMSE',
+                                             'RMSEP_low', 'RMSEP_high', 'alert'])
+
+    def status(self):
+        '''
+        Current window and weighted RMSE of each target and oxide
+        '''
+        rows = [[target, oxide, e.n, len(e.errors), e.rmse(), e.ewma_rmse(), *self.bands.get(oxide, (None, None)), e.state]
+                for (target, oxide), e in sorted(self.errors.items())]
+        return pd.DataFrame(rows, columns=['target', 'oxide', 'n', 'window_n', 'window_RMSE', 'ewma_RMSE',
+                                           'RMSEP_low', 'RMSEP_high', 'state'])
+
+def load_truth(path, target='target'):
+    '''
+    {target: {oxide: true value}} from a table with a target column and
+    <oxide>_actual columns (such as the <instrument>_pred_true_summary.csv
+    written by caltarget_accuracy.py)
+    '''
+    df = pd.read_csv(path)
+    actual_cols = [c for c in df.columns if c.endswith('_actual')]
+    df = df.set_index(target)[actual_cols]
+    df.columns = [c[:-len('_actual')] for c in actual_cols]
+    return {t:row.dropna().to_dict() for t, row in df.iterrows()}
+
+def chemcam_bands(df, oxides):
+    '''
+    Reported RMSEP band of each oxide from the '<oxide> RMSEP' columns of df
+    '''
+    bands = dict()
+    for oxide in oxides:
+        avg = df[oxide+' RMSEP'].mean()
+        std = df[oxide+' RMSEP'].std()
+        bands[oxide] = (avg - std/2, avg + std/2)
+    return bands
+
+def supercam_bands(moc_path):
+    '''
+    Reported RMSEP of each oxide from the summary rows of supercam_libs_moc.csv
+    '''
+    reported = pd.read_csv(moc_path, nrows=7)
+    reported = reported[[c for c in reported.columns if 'Unnamed' not in c]]
+    rmsep = reported[reported['Training set Quartiles']=='RMSEP'].iloc[0]
+    return {oxide:(0, float(rmsep[oxide])) for oxide in reported.columns[1:] if 'stdev' not in oxide}
+
+def update_monitor(folder, prefix, date, df, truth, bands, target='target', window=20, alpha=0.1):
+    '''
+    Feed the new caltarget rows of df to the monitor kept in folder,
+    write its status and any alerts, and save it
+    '''
+    monitor_path = f'{folder}\\{prefix}_drift_monitor.pkl'
+    monitor = DriftMonitor.load(monitor_path, truth, bands, window=window, alpha=alpha)
+    n_seen = len(monitor.seen)
+    alerts = monitor.observe_table(df, target)
+
+    monitor.status().to_csv(f'{folder}\\{prefix}_drift_{date}.csv', index=False)
+    print(f'{len(monitor.seen) - n_seen} new caltarget observations checked for drift')
+    if len(alerts) > 0:
+        alerts_path = f'{folder}\\{prefix}_drift_alerts_{date}.csv'
+        alerts.to_csv(alerts_path, index=False)
+        for row in alerts.itertuples(index=False):
+            print(f'sol {row.sol}, {row.target} {row.oxide}: RMSE {row.window_RMSE:.2f} {row.alert}')
+        print(f'{len(alerts)} drift alerts, listed in {alerts_path}')
+    monitor.save(monitor_path)
+    return alerts
@@ -0,0 +1,37 @@
+import io
+import pandas as pd
+
+from pds_metrics import timed
+from spectral_store import same_wave
+
+'''
+Parsing of ChemCam LIBS CCS products
+
+Kept in its own module so the ingest pipeline can run it on worker
+processes.
+'''
+
+def read_ccs(data):
+    '''
+    Table of a downloaded CCS .csv
+    '''
+    with timed('csv parse'):
+        s = pd.read_csv(io.BytesIO(data), skiprows=16)
+    s.columns = [c.strip() for c in list(s.columns)]
+    return s
+
+def read_wave(data):
+    '''
+    Wavelength axis of a downloaded CCS .csv
+    '''
+    return read_ccs(data)['# wave'].values
+
+def parse_ccs(product, data, wave=None):
+    '''
+    Mean spectrum of a downloaded CCS .csv. wave is the shared ChemCam
+    wavelength axis; if given, a product on another axis raises ValueError.
+    '''
+    s = read_ccs(data)
+    if wave is not None and not same_wave(s['# wave'].values, wave):
+        raise ValueError('Wavelength axis does not match the shared ChemCam axis')
+    return s['mean'].values
@@ -0,0 +1,99 @@
+import io
+import os
+import re
+import glob
+import hashlib
+import threading
+import pandas as pd
+
+from pds_schema import CHEMCAM_MOC, apply_schema
+
+'''
+ChemCam MOC (predicted composition) ingest
+
+Every moc*.csv on the PDS moc/ page is fetched on the Downloader's
+threads. Each parsed file is kept in a cache folder as a pickled
+DataFrame named by the file and the checksum of its contents,
+    <moc file>.<md5>.pkl
+so a file PDS hasn't changed (served from the response cache on a
+refresh) is loaded typed instead of being parsed again. The composite
+table is built with a single concat at the end.
+'''
+
+def parse_moc(moc, data):
+    '''
+    One downloaded moc*.csv as a table keyed by pkey
+    '''
+    df = pd.read_csv(io.BytesIO(data), skiprows=6)
+
+    # format
+    # remove +/- columns
+    df = df[[c for c in df.columns if '+/-' not in c]]
+    # add pkey column
+    df.insert(0,'pkey',[p[:-4].lower() for p in df.File])
+    # don't need File anymore
+    df = df.drop(columns='File')
+    df['Source File'] = moc[:-4]
+    return apply_schema(df, CHEMCAM_MOC)
+
+
+class ParsedCache:
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _path(self, name, checksum):
+        return os.path.join(self.folder, f'{name}.{checksum}.pkl')
+
+    def load(self, name, checksum):
+        path = self._path(name, checksum)
+        if not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return pd.read_pickle(path)
+
+    def store(self, name, checksum, df):
+        path = self._path(name, checksum)
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, path)
+        # older versions of this file are out of date now
+        for old in glob.glob(os.path.join(glob.escape(self.folder), f'{glob.escape(name)}.*.pkl')):
+            if old != path:
+                os.remove(old)
+
+
+def ingest_moc(dl, moc_url, cache):
+    '''
+    Composite table of all moc*.csv files listed at moc_url
+    '''
+    moc_page = dl.get_text(moc_url)
+    moc_files = sorted(set(re.findall(r'moc.{10}\.csv', moc_page)))
+
+    def get_moc(moc):
+        data = dl.get_content(moc_url+moc)
+        checksum = hashlib.md5(data).hexdigest()
+        df = cache.load(moc, checksum)
+        if df is None:
+            df = parse_moc(moc, data)
+            cache.store(moc, checksum, df)
+        return moc, df
+
+    dfs = []
+    for moc, df in dl.imap(get_moc, moc_files):
+        if len(dfs) > 0 and list(df.columns) != list(dfs[0].columns):
+            print(moc, 'has different format')
+        dfs.append(df)
+
+    print(f'{cache.hits} MOC files unchanged, {cache.misses} parsed')
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=['pkey', 'Source File'])
+    # categories differ from file to file, so they are set again on the composite
+    return apply_schema(pd.concat(dfs, ignore_index=True), CHEMCAM_MOC)
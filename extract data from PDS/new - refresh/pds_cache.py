@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import threading
+
+'''
+On-disk HTTP response cache for the PDS ingest scripts
+
+Each URL is stored as two files named by the hash of the URL: the
+(decompressed) body and a small .json record with the validators the
+server sent (ETag, Last-Modified) and the size of the body on disk. The
+Downloader uses these to make conditional requests, so unchanged
+products are read back from disk and only files PDS has republished are
+downloaded again.
+'''
+
+class ResponseCache:
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key+'.json'), os.path.join(self.folder, key+'.body')
+
+    def lookup(self, url):
+        '''
+        Return the stored record for url, or None if it is missing or
+        the body on disk doesn't match the recorded body size
+        '''
+        record_path, body_path = self._paths(url)
+        if not (os.path.exists(record_path) and os.path.exists(body_path)):
+            return None
+        with open(record_path) as f:
+            record = json.load(f)
+        if record['url'] != url:
+            return None
+        # size of the decoded body, not the Content-Length of a compressed response
+        if os.path.getsize(body_path) != record['body_size']:
+            return None
+        return record
+
+    def conditional_headers(self, record):
+        headers = dict()
+        if record is None:
+            return headers
+        if record['etag']:
+            headers['If-None-Match'] = record['etag']
+        if record['last_modified']:
+            headers['If-Modified-Since'] = record['last_modified']
+        return headers
+
+    def load(self, url):
+        with self._lock:
+            self.hits += 1
+        with open(self._paths(url)[1], 'rb') as f:
+            return f.read()
+
+    def store(self, url, response):
+        with self._lock:
+            self.misses += 1
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        # nothing to revalidate against, so don't keep it
+        if not (etag or last_modified):
+            return
+
+        record = {
+            'url':url,
+            'etag':etag,
+            'last_modified':last_modified,
+            'body_size':len(response.content),
+            'encoding':response.encoding
+        }
+        record_path, body_path = self._paths(url)
+
+        # write to temporary files first so a crash never leaves a half-written entry
+        for path, data, mode in [(body_path, response.content, 'wb'),
+                                 (record_path, json.dumps(record), 'w')]:
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, mode) as f:
+                f.write(data)
+            os.replace(tmp_path, path)
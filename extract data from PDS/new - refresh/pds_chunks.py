@@ -0,0 +1,73 @@
+import os
+import glob
+import pandas as pd
+
+from pds_schema import apply_schema
+
+'''
+Append-only chunked table output for the PDS ingest scripts
+
+Each checkpoint writes its rows to a new part file in a parts folder
+instead of rewriting the whole output .csv. A part only counts once its
+commit marker (part_<n>.ok) exists, and the marker is written after the
+part has been moved into place, so a run that breaks loses at most the
+chunk it was writing. The consolidated .csv is built once, at the end.
+'''
+
+class ChunkedTable:
+
+    def __init__(self, folder, columns):
+        self.folder = folder
+        self.columns = list(columns)
+        os.makedirs(folder, exist_ok=True)
+
+        # clear out parts that never got their commit marker
+        for path in glob.glob(os.path.join(folder, 'part_*.csv')):
+            if not os.path.exists(path[:-4]+'.ok'):
+                os.remove(path)
+        for path in glob.glob(os.path.join(folder, 'part_*.tmp')):
+            os.remove(path)
+
+    def parts(self):
+        markers = sorted(glob.glob(os.path.join(self.folder, 'part_*.ok')))
+        return [m[:-3]+'.csv' for m in markers]
+
+    def _next_id(self):
+        ids = [int(os.path.basename(p)[5:-4]) for p in self.parts()]
+        return max(ids) + 1 if len(ids) > 0 else 0
+
+    def write(self, df):
+        '''
+        Commit df as a new part
+        '''
+        if len(df) == 0:
+            return
+        base = os.path.join(self.folder, f'part_{self._next_id():06d}')
+        df[self.columns].to_csv(base+'.tmp', index=False)
+        os.replace(base+'.tmp', base+'.csv')
+        open(base+'.ok', 'w').close()
+
+    def read(self, dtype=None):
+        parts = [pd.read_csv(p, dtype=dtype) for p in self.parts()]
+        if len(parts) == 0:
+            return pd.DataFrame(columns=self.columns)
+        return pd.concat(parts, ignore_index=True)
+
+    def consolidate(self, path, key=None, dtype=None, schema=None, sort_by=None):
+        '''
+        Build the final .csv from all committed parts in one pass.
+        Rows repeated for the same key (a chunk redone after a break)
+        keep their latest copy. Parts are read as dtype, then cast to
+        schema if one is given, and sorted by the sort_by columns.
+        '''
+        df = self.read(dtype=dtype)
+        if schema is not None:
+            df = apply_schema(df, schema)
+        if key is not None:
+            df = df.drop_duplicates(subset=key, keep='last', ignore_index=True)
+        else:
+            df = df.drop_duplicates(ignore_index=True)
+        if sort_by is not None:
+            df = df.sort_values(sort_by, ignore_index=True)
+        df.to_csv(path, index=False)
+        return df
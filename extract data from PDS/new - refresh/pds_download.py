@@ -0,0 +1,157 @@
+import time
+import random
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+'''
+Shared download engine for the PDS ingest scripts
+
+Requests go through one pooled requests.Session (keep-alive connections
+are reused between files) and a bounded thread pool. A per-host
+semaphore caps how many requests hit the same server at once.
+
+Each request is retried on its own: connection errors, timeouts and
+429/5xx responses are retried with exponential backoff and jitter (or
+after the Retry-After the server asks for), so a flaky server slows
+the files it fails on instead of restarting the whole run.
+
+If a ResponseCache is given, requests are made conditional on the
+cached ETag/Last-Modified and a 304 response is served from disk.
+
+URLs can also be paths into a local mirror of the archive (or file://
+URLs), which are read straight from disk.
+'''
+
+def is_local(url):
+    return not urlparse(url).scheme.startswith('http')
+
+def local_path(url):
+    return url[7:] if url.startswith('file://') else url
+
+# worth asking again, the server may be busy or restarting
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+class Downloader:
+
+    def __init__(self, n_workers=8, per_host=4, timeout=(10, 60), cache=None,
+                 retries=4, backoff=1, max_backoff=60):
+        self.n_workers = n_workers
+        self.per_host = per_host
+        # (connect, read) seconds, per request
+        self.timeout = timeout
+        self.cache = cache
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        # one connection pool per host, sized to the host limit (at most
+        # per_host requests to a host are in flight, see _host_limit)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=per_host)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        self._pool = ThreadPoolExecutor(max_workers=n_workers)
+        self._host_limits = dict()
+        self._lock = threading.Lock()
+        # for the run report, bytes are those received over the network
+        self.stats = {'requests':0, 'retries':0, 'not_modified':0, 'bytes':0}
+
+    def _count(self, **counts):
+        with self._lock:
+            for name, n in counts.items():
+                self.stats[name] += n
+
+    def _host_limit(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _wait(self, attempt, response=None):
+        # full jitter, so threads that failed together don't retry together
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+        if response is not None and response.headers.get('Retry-After', '').isdigit():
+            delay = min(self.max_backoff, int(response.headers['Retry-After']))
+        time.sleep(delay)
+
+    def get(self, url, headers=None):
+        for attempt in range(self.retries + 1):
+            response = None
+            try:
+                with self._host_limit(url):
+                    response = self.session.get(url, headers=headers, timeout=self.timeout)
+                self._count(requests=1, bytes=len(response.content))
+                if response.status_code not in RETRY_STATUS:
+                    break
+                error = requests.HTTPError(f'{response.status_code} Server Error for url: {url}', response=response)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt == self.retries:
+                raise error
+            # waits outside the host limit, other files carry on
+            self._count(retries=1)
+            self._wait(attempt, response)
+
+        if response.status_code == 304:
+            self._count(not_modified=1)
+        else:
+            response.raise_for_status()
+        return response
+
+    def _fetch(self, url):
+        # returns (body, encoding)
+        if is_local(url):
+            with open(local_path(url), 'rb') as f:
+                return f.read(), 'utf-8'
+
+        if self.cache is None:
+            response = self.get(url)
+            return response.content, response.encoding
+
+        record = self.cache.lookup(url)
+        response = self.get(url, headers=self.cache.conditional_headers(record))
+        if response.status_code == 304 and record is not None:
+            return self.cache.load(url), record['encoding']
+
+        self.cache.store(url, response)
+        return response.content, response.encoding
+
+    def get_text(self, url):
+        content, encoding = self._fetch(url)
+        return content.decode(encoding or 'utf-8', errors='replace')
+
+    def get_content(self, url):
+        return self._fetch(url)[0]
+
+    def imap(self, func, items, window=None):
+        '''
+        Apply func to each item on the thread pool, yielding results
+        in input order. At most `window` calls are in flight so memory
+        stays bounded on long file lists.
+        '''
+        window = window or 2 * self.n_workers
+        items = iter(items)
+        pending = deque(self._pool.submit(func, i) for i in itertools.islice(items, window))
+        while pending:
+            result = pending.popleft().result()
+            for i in itertools.islice(items, 1):
+                pending.append(self._pool.submit(func, i))
+            yield result
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,140 @@
+import os
+import re
+import json
+import hashlib
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlparse, unquote
+
+from pds_download import is_local, local_path
+
+'''
+Product enumeration for the PDS ingest scripts
+
+PDS4 bundles (SuperCam) publish a collection inventory listing every
+product in a collection, so the whole product list comes from one file
+instead of a request per sol page. Where there is no inventory (ChemCam
+is a PDS3 volume) directory pages are read as listings: the links on
+the page are parsed rather than matched against fixed-width regexes.
+
+Both work on a URL or on a local mirror of the archive. Parsed listings
+are kept in a .json file between runs, keyed by page and checksum, so
+pages that haven't changed (served by the response cache) aren't parsed
+again.
+'''
+
+class ListingCache:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = dict()
+        if os.path.exists(path):
+            with open(path) as f:
+                self._entries = json.load(f)
+
+    def get(self, url, data, parse):
+        '''
+        parse(data) for the page at url, reused while its bytes are unchanged
+        '''
+        checksum = hashlib.md5(data).hexdigest()
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry is not None and entry['checksum'] == checksum:
+            return entry['listing']
+        listing = parse(data)
+        with self._lock:
+            self._entries[url] = {'checksum':checksum, 'listing':listing}
+        return listing
+
+    def save(self):
+        with self._lock:
+            tmp_path = self.path+'.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self._entries, f)
+            os.replace(tmp_path, self.path)
+
+
+class _LinkParser(HTMLParser):
+
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            for name, value in attrs:
+                if name == 'href' and value:
+                    self.links.append(value)
+
+def parse_listing(url, page):
+    '''
+    Names of the entries directly under url linked from a directory
+    page, subdirectories ending in /
+    '''
+    parser = _LinkParser()
+    parser.feed(page)
+    base = urlparse(url).path
+    names = set()
+    for link in parser.links:
+        path = unquote(urlparse(urljoin(url, link)).path)
+        # only children of this directory (not parents, sorting links or other sites)
+        if not path.startswith(base) or path == base:
+            continue
+        name = path[len(base):]
+        if '/' not in name.rstrip('/'):
+            names.add(name)
+    return sorted(names)
+
+def list_directory(dl, url, cache=None):
+    '''
+    Names of the files (and subdirectories, ending in /) at url
+    '''
+    if is_local(url):
+        path = local_path(url)
+        return sorted(n+'/' if os.path.isdir(os.path.join(path, n)) else n for n in os.listdir(path))
+
+    data = dl.get_content(url)
+    parse = lambda data: parse_listing(url, data.decode('utf-8', errors='replace'))
+    return parse(data) if cache is None else cache.get(url, data, parse)
+
+def parse_inventory(data):
+    '''
+    Product ids of the primary members of a PDS4 collection inventory
+    (rows of member status, LIDVID), latest version of each
+    '''
+    products = dict()
+    for line in data.decode('utf-8', errors='replace').splitlines():
+        fields = line.split(',')
+        if len(fields) < 2 or fields[0].strip().upper() != 'P':
+            continue
+        lid, _, vid = fields[1].strip().partition('::')
+        product_id = lid.split(':')[-1]
+        version = tuple(int(v) for v in vid.split('.')) if vid else (0,)
+        if product_id not in products or version > products[product_id]:
+            products[product_id] = version
+    return sorted(products)
+
+def inventory_version(name):
+    '''
+    Version of a collection inventory from its file name, e.g. (1, 10)
+    for collection_..._inventory_v1.10.csv, () if it has none
+    '''
+    match = re.search(r'_v(\d+(?:[._]\d+)*)\.csv$', name, flags=re.IGNORECASE)
+    return tuple(int(v) for v in re.split(r'[._]', match.group(1))) if match else ()
+
+def read_inventory(dl, collection_url, cache=None):
+    '''
+    Product ids listed in the latest inventory of the collection at
+    collection_url. Raises FileNotFoundError if the collection has no
+    inventory.
+    '''
+    inventories = [n for n in list_directory(dl, collection_url, cache)
+                   if n.startswith('collection') and 'inventory' in n and n.endswith('.csv')]
+    if len(inventories) == 0:
+        raise FileNotFoundError(f'No collection inventory in {collection_url}')
+
+    # by version number, not name (v10 sorts before v9)
+    url = collection_url+max(inventories, key=lambda n: (inventory_version(n), n))
+    data = dl.get_content(url)
+    return parse_inventory(data) if cache is None else cache.get(url, data, parse_inventory)
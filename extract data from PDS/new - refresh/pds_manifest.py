@@ -0,0 +1,148 @@
+import sqlite3
+import threading
+
+'''
+Product-level ingest manifest for the PDS ingest scripts
+
+One SQLite row per product (pkey, sol, source URL, size, checksum and
+ingest status). Every refresh lists the sol pages into the manifest,
+then downloads only the products not yet ingested into that run's
+outputs, so a broken run resumes at the exact file it stopped on.
+
+Columns:
+    listed     - last run (date stamp) whose sol listing included the product
+    run        - last run the product was ingested into (or failed in)
+    first_seen - run the product first appeared in
+    changed    - last run in which PDS served different bytes for it
+'''
+
+class Manifest:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.executescript('''
+            CREATE TABLE IF NOT EXISTS products (
+                pkey TEXT PRIMARY KEY,
+                sol INTEGER NOT NULL,
+                url TEXT NOT NULL,
+                size INTEGER,
+                checksum TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                listed TEXT,
+                run TEXT,
+                first_seen TEXT,
+                changed TEXT
+            );
+            CREATE INDEX IF NOT EXISTS products_sol ON products (sol);
+            CREATE INDEX IF NOT EXISTS products_status ON products (listed, status, run);
+        ''')
+
+    def add_listing(self, products, run):
+        '''
+        Record (pkey, sol, url) tuples found on the sol pages for this run
+        '''
+        with self._lock, self.con:
+            self.con.executemany('''
+                INSERT INTO products (pkey, sol, url, listed, first_seen)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (pkey) DO UPDATE SET
+                    sol = excluded.sol,
+                    url = excluded.url,
+                    listed = excluded.listed
+            ''', [(pkey, int(sol), url, run, run) for pkey, sol, url in products])
+
+    def listed_sols(self, run):
+        with self._lock:
+            rows = self.con.execute('SELECT DISTINCT sol FROM products WHERE listed = ? ORDER BY sol',
+                                    (run,)).fetchall()
+        return [r[0] for r in rows]
+
+    def todo(self, run, retry_failed=False):
+        '''
+        (pkey, sol, url) of listed products not yet ingested into this
+        run, by sol. Products set aside by this run are left out unless
+        retry_failed.
+        '''
+        skip = ('done',) if retry_failed else ('done', 'failed')
+        with self._lock:
+            return self.con.execute(f'''
+                SELECT pkey, sol, url FROM products
+                WHERE listed = ? AND NOT (status IN ({','.join('?'*len(skip))}) AND run IS ?)
+                ORDER BY sol, pkey
+            ''', (run, *skip, run)).fetchall()
+
+    def mark_done(self, products, run):
+        '''
+        Record (pkey, size, checksum) for products written to this run's outputs
+        '''
+        with self._lock, self.con:
+            self.con.executemany('''
+                UPDATE products SET
+                    changed = CASE WHEN checksum IS NOT NULL AND checksum != ? THEN ? ELSE changed END,
+                    size = ?,
+                    checksum = ?,
+                    status = 'done',
+                    run = ?
+                WHERE pkey = ?
+            ''', [(checksum, run, size, checksum, run, pkey) for pkey, size, checksum in products])
+
+    def mark_failed(self, pkeys, run):
+        '''
+        Set aside products that couldn't be fetched or parsed in this
+        run, they are tried again by the next one
+        '''
+        with self._lock, self.con:
+            self.con.executemany("UPDATE products SET status = 'failed', run = ? WHERE pkey = ?",
+                                 [(run, p) for p in pkeys])
+
+    def failed(self, run):
+        '''
+        (pkey, sol, url) of products set aside in this run
+        '''
+        with self._lock:
+            return self.con.execute('''
+                SELECT pkey, sol, url FROM products
+                WHERE status = 'failed' AND run = ?
+                ORDER BY sol, pkey
+            ''', (run,)).fetchall()
+
+    def whats_new(self, run):
+        '''
+        pkeys that first appeared or were republished with different bytes in this run
+        '''
+        with self._lock:
+            new = self.con.execute('SELECT pkey FROM products WHERE first_seen = ? ORDER BY sol, pkey',
+                                   (run,)).fetchall()
+            changed = self.con.execute('SELECT pkey FROM products WHERE changed = ? ORDER BY sol, pkey',
+                                       (run,)).fetchall()
+        return [r[0] for r in new], [r[0] for r in changed]
+
+    def merge(self, path):
+        '''
+        Add the products of another manifest (a shard of a run), its
+        rows replacing ours for the same pkey
+        '''
+        with self._lock, self.con:
+            self.con.execute('ATTACH DATABASE ? AS shard', (path,))
+        try:
+            with self._lock, self.con:
+                self.con.execute('''
+                    INSERT INTO products SELECT * FROM shard.products WHERE true
+                    ON CONFLICT (pkey) DO UPDATE SET
+                        sol = excluded.sol,
+                        url = excluded.url,
+                        size = excluded.size,
+                        checksum = excluded.checksum,
+                        status = excluded.status,
+                        listed = excluded.listed,
+                        run = excluded.run,
+                        changed = COALESCE(excluded.changed, products.changed)
+                ''')
+        finally:
+            with self._lock:
+                self.con.execute('DETACH DATABASE shard')
+
+    def close(self):
+        self.con.close()
@@ -0,0 +1,134 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+
+'''
+Stage-level instrumentation for the PDS ingest scripts
+
+RunMetrics adds up wall time, items and bytes per stage (listing,
+download, parse and its parts, store, exports), in total and per sol,
+and writes them as a JSON run report at the end, together with the
+downloader's request/retry counts and the response cache hit rate.
+With live_path it also rewrites a small metrics file every few seconds
+while the run is going.
+
+Parsing runs on worker processes, so parse functions time their parts
+with timed(), and the pipeline sends those times back with the result
+(see run_timed).
+
+RunMetrics(enabled=False) records nothing, so the scripts can call it
+unconditionally.
+'''
+
+# stage times of the parse call running in this process
+_parse_stages = dict()
+
+@contextmanager
+def timed(stage):
+    '''
+    Time part of a parse function, e.g. with timed('fits decode'):
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _parse_stages[stage] = _parse_stages.get(stage, 0) + time.perf_counter() - start
+
+def run_timed(parse, product, data):
+    '''
+    parse(product, data) plus the times of its stages, including 'parse'
+    for the whole call
+    '''
+    _parse_stages.clear()
+    start = time.perf_counter()
+    parsed = parse(product, data)
+    stages = dict(_parse_stages)
+    stages['parse'] = time.perf_counter() - start
+    return parsed, stages
+
+
+def _rates(entry):
+    entry = {k:round(v, 4) if isinstance(v, float) else v for k, v in entry.items()}
+    if entry['seconds'] > 0:
+        entry['items_per_s'] = round(entry['items'] / entry['seconds'], 2)
+        entry['mb_per_s'] = round(entry['bytes'] / 1e6 / entry['seconds'], 2)
+    return entry
+
+class RunMetrics:
+
+    def __init__(self, enabled=True, live_path=None, live_every=5):
+        self.enabled = enabled
+        self.live_path = live_path
+        self.live_every = live_every
+        self.started = datetime.datetime.now()
+        self._start = time.perf_counter()
+        self._last_live = self._start
+        self.stages = dict()
+        self.sols = dict()
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds=0, items=0, nbytes=0, sol=None):
+        if not self.enabled:
+            return
+        with self._lock:
+            targets = [self.stages]
+            if sol is not None:
+                targets.append(self.sols.setdefault(int(sol), dict()))
+            for target in targets:
+                entry = target.setdefault(stage, {'seconds':0.0, 'items':0, 'bytes':0})
+                entry['seconds'] += seconds
+                entry['items'] += items
+                entry['bytes'] += nbytes
+        if self.live_path and time.perf_counter() - self._last_live > self.live_every:
+            self._last_live = time.perf_counter()
+            self._write(self.live_path, self.summary())
+
+    @contextmanager
+    def stage(self, stage, items=0, nbytes=0, sol=None):
+        '''
+        Time a block as one pass of stage
+        '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start, items, nbytes, sol)
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started':self.started.isoformat(timespec='seconds'),
+                'seconds':round(time.perf_counter() - self._start, 2),
+                'stages':{name:_rates(entry) for name, entry in self.stages.items()}
+            }
+
+    def report(self, path, dl=None, **extra):
+        '''
+        Write the JSON run report. extra items (run, product counts, ...)
+        are added as they are.
+        '''
+        if not self.enabled:
+            return
+        report = self.summary()
+        report['finished'] = datetime.datetime.now().isoformat(timespec='seconds')
+        report.update(extra)
+        if dl is not None:
+            report['downloads'] = dict(dl.stats)
+            if dl.cache is not None:
+                lookups = dl.cache.hits + dl.cache.misses
+                report['cache'] = {'hits':dl.cache.hits,
+                                   'misses':dl.cache.misses,
+                                   'hit_rate':round(dl.cache.hits / lookups, 3) if lookups > 0 else None}
+        with self._lock:
+            report['sols'] = {str(sol):{name:_rates(entry) for name, entry in stages.items()}
+                              for sol, stages in sorted(self.sols.items())}
+        self._write(path, report)
+
+    def _write(self, path, data):
+        tmp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, path)
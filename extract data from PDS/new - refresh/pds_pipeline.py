@@ -0,0 +1,129 @@
+import os
+import time
+import hashlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from pds_metrics import RunMetrics, run_timed
+
+'''
+Producer/consumer pipeline for the PDS ingest scripts
+
+    listing -> download -> parse -> store
+
+Listing fills the manifest (see the ingest scripts). Downloads run on
+the Downloader's I/O threads, parsing runs on a process pool and the
+store stage is the caller's loop over Pipeline.run(). Each hand-off is
+bounded: the Downloader keeps a fixed window of files in flight and at
+most queue_size downloaded products wait for or sit in parsing. When the
+store stage falls behind, downloads and parsing wait for it instead of
+piling up memory.
+
+With an enabled RunMetrics, download and parse times (and the parse
+function's own timed() parts) are recorded per product and sol.
+
+A product that can't be downloaded (after the Downloader's retries) or
+parsed is set aside in Pipeline.failed with its error, and the run
+carries on with the next one.
+
+The parse function must be a top-level function of an importable module
+(or a functools.partial of one) so it can be sent to the worker
+processes; it is called as parse(product, data).
+'''
+
+class Pipeline:
+
+    def __init__(self, dl, parse, n_procs=None, queue_size=None, metrics=None):
+        self.dl = dl
+        self.parse = parse
+        self.metrics = metrics or RunMetrics(enabled=False)
+        # 0 parses in this process, handy for debugging
+        self.n_procs = os.cpu_count() if n_procs is None else n_procs
+        self.queue_size = queue_size or 4 * max(self.n_procs, 1)
+        self._pool = ProcessPoolExecutor(max_workers=self.n_procs) if self.n_procs > 0 else None
+        # (product, error) of products set aside
+        self.failed = []
+
+    def _fetch(self, product):
+        # runs on the download threads, hashing large buffers releases the GIL
+        start = time.perf_counter()
+        try:
+            data = self.dl.get_content(product[2])
+        except Exception as e:
+            return product, None, e
+        self.metrics.add('download', time.perf_counter() - start, 1, len(data), sol=product[1])
+        record = (product[0], len(data), hashlib.md5(data).hexdigest())
+        return product, record, data
+
+    def _parse(self, product, data):
+        # (parsed, stage times) if timed, else (parsed, None)
+        if self.metrics.enabled:
+            return run_timed(self.parse, product, data)
+        return self.parse(product, data), None
+
+    def _record(self, product, nbytes, stages):
+        if stages is not None:
+            for stage, seconds in stages.items():
+                self.metrics.add(stage, seconds, 1, nbytes if stage == 'parse' else 0, sol=product[1])
+
+    def set_aside(self, product, error):
+        '''
+        Set aside a product the store stage couldn't take (e.g. a spectrum
+        on a different wavelength grid), with the ones that failed here
+        '''
+        self.failed.append((product, error))
+
+    def take_failed(self):
+        '''
+        Products set aside since the last call
+        '''
+        failed, self.failed = self.failed, []
+        return failed
+
+    def run(self, products):
+        '''
+        Yield (product, record, parsed) for each (pkey, sol, url) product,
+        in input order. record is (pkey, size, checksum) for the manifest.
+        '''
+        pending = deque()
+        for product, record, data in self.dl.imap(self._fetch, products):
+            if record is None:
+                self.failed.append((product, data))
+                continue
+
+            if self._pool is None:
+                try:
+                    parsed, stages = self._parse(product, data)
+                except Exception as e:
+                    self.failed.append((product, e))
+                    continue
+                self._record(product, record[1], stages)
+                yield product, record, parsed
+                continue
+
+            if self.metrics.enabled:
+                future = self._pool.submit(run_timed, self.parse, product, data)
+            else:
+                future = self._pool.submit(self.parse, product, data)
+            pending.append((product, record, future))
+            # backpressure: wait on the oldest product before taking another download
+            while len(pending) >= self.queue_size:
+                yield from self._result(*pending.popleft())
+
+        while len(pending) > 0:
+            yield from self._result(*pending.popleft())
+
+    def _result(self, product, record, future):
+        try:
+            parsed = future.result()
+        except Exception as e:
+            self.failed.append((product, e))
+            return
+        if self.metrics.enabled:
+            parsed, stages = parsed
+            self._record(product, record[1], stages)
+        yield product, record, parsed
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,81 @@
+import pandas as pd
+
+'''
+Column types of the tables the ingest scripts produce
+
+Each schema maps a column to its dtype. Oxide abundances and their
+RMSEP/stdev columns are numeric in every table, so they are matched by
+name instead of being listed. Schemas are applied as tables are parsed
+(and when .csv checkpoints are read back), so sols are integers,
+repeated labels like target and producer are categoricals and
+compositions are floats rather than all strings.
+'''
+
+# predicted major element abundances
+OXIDES = ['SiO2', 'TiO2', 'Al2O3', 'FeOT', 'MgO', 'CaO', 'Na2O', 'K2O', 'MnO']
+
+def is_comp(column):
+    return str(column).split(' ')[0].split('_')[0] in OXIDES
+
+SUPERCAM_META = {
+    'pkey':'str',
+    'sol':'int32',
+    'sclock':'str',
+    'seq_n':'category',
+    'target':'category',
+    'location_n':'category',
+    'producer':'category',
+    'version':'category'
+}
+
+# supercam_libs_moc.csv once its header rows are dropped
+SUPERCAM_COMPS = {
+    'pkey':'str'
+}
+
+CHEMCAM_META = {
+    'pkey':'str',
+    'sol':'int32'
+}
+
+# moc*.csv files
+CHEMCAM_MOC = {
+    'pkey':'str',
+    'Target':'category',
+    'Sum of Oxides':'float64',
+    'Distance (m)':'float64',
+    'Laser Power':'category',
+    'Spectrum Total':'float64',
+    'Source File':'category'
+}
+
+def apply_schema(df, schema):
+    '''
+    Cast the columns of df to their schema types, composition columns
+    to float64. Columns the schema doesn't know are left as they are.
+    Values of float64 columns that aren't numbers become NaN, and the
+    ones replaced are printed.
+    '''
+    types = dict()
+    for column in df.columns:
+        if column in schema:
+            types[column] = schema[column]
+        elif is_comp(column):
+            types[column] = 'float64'
+    for column, dtype in types.items():
+        if dtype == 'float64' and not pd.api.types.is_numeric_dtype(df[column]):
+            values = pd.to_numeric(df[column], errors='coerce')
+            coerced = df[column][values.isna() & df[column].notna()]
+            if len(coerced) > 0:
+                print(f'{column}: {len(coerced)} values not numeric, set to NaN ({", ".join(map(repr, coerced.unique()[:5]))})')
+            df[column] = values
+    return df.astype(types)
+
+def join(left, right, key='pkey'):
+    '''
+    Inner join on key through an index on the right table, keeping the
+    row order of left (same result as left.merge(right) on key). Other
+    columns in both tables get merge's _x and _y suffixes.
+    '''
+    return left.join(right.set_index(key), on=key, how='inner',
+                     lsuffix='_x', rsuffix='_y').reset_index(drop=True)
@@ -0,0 +1,212 @@
+import os
+import re
+import glob
+import shutil
+import argparse
+import datetime
+import importlib
+import pandas as pd
+
+from pds_manifest import Manifest
+from spectral_store import SpectralStore
+from product_store import ProductStore
+from pyhat_export import write_pyhat
+from pds_target_index import write_by_target
+from pds_schema import SUPERCAM_META, CHEMCAM_META, CHEMCAM_MOC, apply_schema
+
+'''
+Sol-range sharding of a PDS refresh
+
+A refresh can be split into shards, each run (on any machine) into its
+own folder with the ingest script limited to a range of sols, or to
+every count-th sol with shard index/count. Each shard folder holds a
+complete set of outputs for its sols. merge combines shard folders into
+the usual dated outputs in one folder, and stops if a pkey turns up in
+more than one shard.
+
+    python pds_shards.py run SuperCam <shard folder> --sols 0 499
+    python pds_shards.py run SuperCam <shard folder> --shard 0 4
+    python pds_shards.py merge SuperCam <folder> <shard folder> <shard folder> ...
+'''
+
+INSTRUMENTS = {
+    'SuperCam':{
+        'script':'add_SuperCam_LIBS_data_from_PDS',
+        'prefix':'LIBS_RDR',
+        'merged':'metadata_w_pred_comps',
+        'target':'target',
+        'schema':SUPERCAM_META,
+        'folders':['LIBS RDR laser data', 'LIBS RDR spectra', 'LIBS RDR fits files'],
+        'products':'LIBS RDR products',
+        'copied':['supercam_libs_moc']
+    },
+    'ChemCam':{
+        'script':'add_ChemCam_LIBS_data_from_PDS',
+        'prefix':'LIBS_CCS',
+        'merged':'metadata_w_moc',
+        'target':'Target',
+        'schema':{**CHEMCAM_MOC, **CHEMCAM_META},
+        'folders':[],
+        'products':None,
+        'copied':['moc_composite']
+    }
+}
+
+def sol_filter(sols=None, shard=None):
+    '''
+    keep_sol function for a sol range (first, last) and/or shard (index, count)
+    '''
+    def keep_sol(sol):
+        if sols is not None and not (sols[0] <= sol <= sols[1]):
+            return False
+        if shard is not None and sol % shard[1] != shard[0]:
+            return False
+        return True
+    return keep_sol
+
+def run(instrument, folder, sols=None, shard=None):
+    script = importlib.import_module(INSTRUMENTS[instrument]['script'])
+    script.main(folder, keep_sol=sol_filter(sols, shard))
+
+def latest(folder, name, ext='.csv', required=False):
+    '''
+    Path of the most recent dated output <name>_<ddmmyy><ext> in folder,
+    None if there is none (FileNotFoundError if required)
+    '''
+    dated = dict()
+    for path in glob.glob(f'{folder}\\{name}_*{ext}'):
+        match = re.fullmatch(r'(\d{6})'+re.escape(ext), path[len(f'{folder}\\{name}_'):])
+        if match:
+            dated[datetime.datetime.strptime(match.group(1), '%d%m%y')] = path
+    if len(dated) == 0:
+        if required:
+            raise FileNotFoundError(f'No {name}_<ddmmyy>{ext} output in shard {folder}')
+        return None
+    return dated[max(dated)]
+
+def read_table(path, schema):
+    # read as text, then typed, so ids like version '01' keep their form
+    return apply_schema(pd.read_csv(path, dtype=str), schema)
+
+def merge(instrument, folder, shards, drop_duplicates=False):
+    '''
+    Combine shard folders into the dated outputs in folder.
+    A pkey found in more than one shard is an error, unless
+    drop_duplicates, which keeps the copy from the first shard.
+    '''
+    info = INSTRUMENTS[instrument]
+    prefix = info['prefix']
+    date = datetime.datetime.now().strftime("%d%m%y")
+    os.makedirs(folder, exist_ok=True)
+
+    metas = []
+    for shard in shards:
+        meta = read_table(latest(shard, f'{prefix}_metadata', required=True), info['schema'])
+        meta['shard'] = shard
+        metas.append(meta)
+    meta = pd.concat(metas, ignore_index=True)
+
+    # shards should never overlap
+    repeated = meta[meta.pkey.duplicated(keep=False)]
+    if len(repeated) > 0:
+        print(f'{repeated.pkey.nunique()} pkeys are in more than one shard:')
+        print(repeated.groupby('pkey')['shard'].apply(list).head(10).to_string())
+        if not drop_duplicates:
+            raise ValueError('Duplicate pkeys across shards, check their sol ranges (or merge with drop_duplicates)')
+    # in sol order, as a single run would have written them
+    meta = meta.drop_duplicates(subset='pkey').sort_values(['sol', 'pkey'], ignore_index=True)
+    sol_of = dict(zip(meta.pkey, meta.sol))
+    meta = meta.drop(columns='shard')
+    meta.to_csv(f'{folder}\\{prefix}_metadata_{date}.csv', index=False)
+
+    # metadata with compositions
+    merged = pd.concat([read_table(latest(shard, f'{prefix}_{info["merged"]}', required=True), info['schema']) for shard in shards],
+                       ignore_index=True)
+    merged = merged.drop_duplicates(subset='pkey').sort_values(['sol', 'pkey'], ignore_index=True)
+    merged_path = f'{folder}\\{prefix}_{info["merged"]}_{date}.csv'
+    merged.to_csv(merged_path, index=False)
+    write_by_target(merged, merged_path, target=info['target'])
+
+    # spectra, appended shard by shard (repeated pkeys are skipped by the store)
+    store = None
+    for shard in shards:
+        path = latest(shard, f'{prefix}_mean_spectra', ext='')
+        if path is None or not SpectralStore.exists(path):
+            continue
+        shard_store = SpectralStore(path)
+        if store is None:
+            store = SpectralStore(f'{folder}\\{prefix}_mean_spectra_{date}', wave=shard_store.wave, dtype=shard_store.dtype)
+        matrix = shard_store.matrix()
+        for start in range(0, len(shard_store), 1000):
+            store.append(shard_store.pkeys[start:start+1000], matrix[start:start+1000], wave=shard_store.wave)
+    if store is not None:
+        store.to_csv(f'{folder}\\{prefix}_mean_spectra_{date}.csv')
+
+    # per-product outputs
+    for name in info['folders']:
+        done = set()
+        for shard in shards:
+            files = glob.glob(f'{shard}\\{name}\\*')
+            if len(files) > 0:
+                os.makedirs(f'{folder}\\{name}', exist_ok=True)
+            for path in files:
+                filename = path[len(f'{shard}\\{name}\\'):]
+                if filename not in done:
+                    shutil.copy2(path, f'{folder}\\{name}\\{filename}')
+                    done.add(filename)
+    if info['products'] is not None:
+        products = None
+        for shard in shards:
+            if not os.path.exists(os.path.join(f'{shard}\\{info["products"]}', 'index.csv')):
+                continue
+            if products is None:
+                products = ProductStore(f'{folder}\\{info["products"]}')
+            shard_products = ProductStore(f'{shard}\\{info["products"]}', readonly=True)
+            for pkey in shard_products.index:
+                if pkey in sol_of and pkey not in products:
+                    products.write(pkey, sol_of[pkey], shard_products.tables(pkey))
+            shard_products.close()
+            products.flush()
+        if products is not None:
+            products.close()
+
+    # whole-archive files, the same in every shard, from the most recent one
+    for name in info['copied']:
+        paths = [p for p in [latest(shard, name) for shard in shards] if p is not None]
+        if len(paths) > 0:
+            shutil.copy2(max(paths, key=lambda p: datetime.datetime.strptime(p[-10:-4], '%d%m%y')),
+                         f'{folder}\\{name}_{date}.csv')
+
+    # product history (first seen, republished) carries over to refreshes of the merged folder
+    manifest = Manifest(f'{folder}\\{prefix}_manifest.sqlite')
+    for shard in shards:
+        if os.path.exists(f'{shard}\\{prefix}_manifest.sqlite'):
+            manifest.merge(f'{shard}\\{prefix}_manifest.sqlite')
+    manifest.close()
+
+    if store is not None:
+        write_pyhat(f'{folder}\\{prefix}_data_PyHAT_{date}.csv', merged, store)
+    print(f'{len(meta)} products from {len(shards)} shards merged')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run or merge shards of a PDS refresh')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='refresh one shard into its own folder')
+    run_parser.add_argument('instrument', choices=list(INSTRUMENTS))
+    run_parser.add_argument('folder')
+    run_parser.add_argument('--sols', nargs=2, type=int, metavar=('FIRST', 'LAST'))
+    run_parser.add_argument('--shard', nargs=2, type=int, metavar=('INDEX', 'COUNT'))
+
+    merge_parser = commands.add_parser('merge', help='combine shard folders into one set of outputs')
+    merge_parser.add_argument('instrument', choices=list(INSTRUMENTS))
+    merge_parser.add_argument('folder')
+    merge_parser.add_argument('shards', nargs='+')
+    merge_parser.add_argument('--drop-duplicates', action='store_true')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args.instrument, args.folder, args.sols, args.shard)
+    else:
+        merge(args.instrument, args.folder, args.shards, args.drop_duplicates)
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pandas as pd
+
+'''
+Target-partitioned copy of a metadata table
+
+The rows of a table such as LIBS_CCS_metadata_w_moc_<date>.csv are
+written again to <name>_by_target.csv, sorted by target and sol, in
+blocks of one target and sols_per_block sols. <name>_by_target_index.csv
+lists the target, first and last sol, row count and byte range of each
+block, so a reader after a few targets and sols seeks to their blocks
+and parses only those bytes (load_rows in caltarget_accuracy.py at the
+top of the repo). The copy is itself a complete .csv.
+'''
+
+def by_target_paths(path):
+    '''
+    Paths of the copy and of its index for the table at path
+    '''
+    base = path[:-4] if path.endswith('.csv') else path
+    return base+'_by_target.csv', base+'_by_target_index.csv'
+
+def write_by_target(df, path, target='target', sols_per_block=100, chunk_rows=50000):
+    '''
+    Write the copy and index of table df (to be) saved at path.
+    Returns the index.
+    '''
+    copy_path, index_path = by_target_paths(path)
+    df = df.sort_values([target, 'sol'], kind='stable', ignore_index=True)
+
+    # block boundaries, where the target or the sol block changes
+    targets = df[target].astype(str).to_numpy()
+    blocks = (df.sol // sols_per_block).to_numpy()
+    changes = np.flatnonzero((targets[1:] != targets[:-1]) | (blocks[1:] != blocks[:-1])) + 1
+    changes = [0] + changes.tolist() + [len(df)] if len(df) > 0 else [0]
+
+    # rows are written a chunk at a time, their byte offsets taken from the line lengths
+    # (split on \n, so a \r\n line terminator stays with its line)
+    offsets = np.empty(len(df) + 1, dtype='int64')
+    with open(copy_path+'.tmp', 'wb') as f:
+        f.write(df.iloc[:0].to_csv(index=False).encode())
+        offsets[0] = f.tell()
+        for start in range(0, len(df), chunk_rows):
+            chunk = df.iloc[start:start+chunk_rows]
+            text = chunk.to_csv(index=False, header=False).encode()
+            lines = text.split(b'\n')[:-1]
+            if len(lines) == len(chunk):
+                lengths = [len(line) + 1 for line in lines]
+            else:
+                # a value with a line break in it, so rows aren't lines
+                lengths = [len(chunk.iloc[i:i+1].to_csv(index=False, header=False).encode())
+                           for i in range(len(chunk))]
+            offsets[start+1:start+len(chunk)+1] = f.tell() + np.cumsum(lengths)
+            f.write(text)
+
+    sols = df.sol.to_numpy()
+    index = [[targets[start], int(sols[start:stop].min()), int(sols[start:stop].max()), stop-start,
+              int(offsets[start]), int(offsets[stop] - offsets[start])]
+             for start, stop in zip(changes[:-1], changes[1:])]
+    index = pd.DataFrame(index, columns=['target', 'first_sol', 'last_sol', 'n_rows', 'offset', 'length'])
+
+    # the index last, a copy only counts once it is indexed
+    os.replace(copy_path+'.tmp', copy_path)
+    index.to_csv(index_path+'.tmp', index=False)
+    os.replace(index_path+'.tmp', index_path)
+    return index
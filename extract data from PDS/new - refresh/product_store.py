@@ -0,0 +1,104 @@
+import os
+import pandas as pd
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+'''
+Consolidated HDF5 output for per-product SuperCam tables
+
+Optional alternative to writing LIBS RDR laser data/<pkey>.csv and
+LIBS RDR spectra/<pkey>.csv for every product (needs h5py). Products go
+into a few HDF5 files partitioned by sol range,
+    products_<first sol>-<last sol>.h5
+with one group per pkey holding a dataset per table ('laser', 'spectra')
+and the column names as an attribute. index.csv maps each pkey to its
+file, so reading one product opens one file.
+'''
+
+class ProductStore:
+
+    def __init__(self, folder, sols_per_file=100, compression='lzf', readonly=False):
+        if h5py is None:
+            raise ImportError('h5py is needed for the hdf5 product format (pip install h5py)')
+        self.folder = folder
+        self.sols_per_file = sols_per_file
+        self.compression = compression
+        self.readonly = readonly
+        os.makedirs(folder, exist_ok=True)
+
+        self._index_path = os.path.join(folder, 'index.csv')
+        if os.path.exists(self._index_path):
+            index = pd.read_csv(self._index_path, dtype=str)
+            self.index = dict(zip(index.pkey, index.file))
+        else:
+            with open(self._index_path, 'w') as f:
+                f.write('pkey,file\n')
+            self.index = dict()
+        self._files = dict()
+        self._new = []
+
+    def _partition(self, sol):
+        first = (int(sol) // self.sols_per_file) * self.sols_per_file
+        return f'products_{first:05d}-{first+self.sols_per_file-1:05d}.h5'
+
+    def _open(self, name):
+        if name not in self._files:
+            self._files[name] = h5py.File(os.path.join(self.folder, name), 'r' if self.readonly else 'a')
+        return self._files[name]
+
+    def write(self, pkey, sol, tables):
+        '''
+        tables: {table name: (array, column names)}
+        '''
+        name = self._partition(sol)
+        f = self._open(name)
+        # redone after a break, replace what was there
+        if pkey in f:
+            del f[pkey]
+        group = f.create_group(pkey)
+        for table, (array, columns) in tables.items():
+            dataset = group.create_dataset(table, data=array, compression=self.compression)
+            dataset.attrs['columns'] = list(columns)
+        if pkey not in self.index:
+            self.index[pkey] = name
+            self._new.append(pkey)
+
+    def flush(self):
+        '''
+        Flush open files to disk and record new products in the index
+        '''
+        if len(self._new) == 0:
+            return
+        for f in self._files.values():
+            f.flush()
+        with open(self._index_path, 'a') as f:
+            f.write(''.join(f'{pkey},{self.index[pkey]}\n' for pkey in self._new))
+        self._new = []
+
+    def __contains__(self, pkey):
+        return pkey in self.index
+
+    def read(self, pkey, table):
+        '''
+        One product's table as a DataFrame
+        '''
+        f = self._open(self.index[pkey])
+        dataset = f[pkey][table]
+        return pd.DataFrame(dataset[()], columns=[str(c) for c in dataset.attrs['columns']])
+
+    def tables(self, pkey):
+        '''
+        All of one product's tables, in the form write() takes
+        '''
+        group = self._open(self.index[pkey])[pkey]
+        return {table:(group[table][()], [str(c) for c in group[table].attrs['columns']]) for table in group}
+
+    def close(self):
+        if not self.readonly:
+            self.flush()
+        for f in self._files.values():
+            f.close()
+        self._files = dict()
@@ -0,0 +1,43 @@
+import pandas as pd
+
+from pds_schema import is_comp
+
+'''
+Streaming export to the PyHAT .csv layout
+
+A PyHAT file has two header rows, the column group of each column
+('meta', 'comp' or 'wvl') and the column names, then one row per
+spectrum. Rows are written a chunk at a time, joining the metadata
+table (with its compositions) to the spectral store by pkey, so only
+one chunk of spectra is ever in memory.
+'''
+
+def column_groups(columns, wave):
+    '''
+    PyHAT group labels for the table columns followed by the wavelengths
+    '''
+    groups = ['comp' if is_comp(c) else 'meta' for c in columns]
+    return groups + ['wvl']*len(wave)
+
+def write_pyhat(path, table, store, key='pkey', chunk_rows=500):
+    '''
+    Write table (one row per pkey) joined with its spectra from store.
+    Rows without a spectrum in the store are left out, like an inner merge.
+    Returns the number of rows written.
+    '''
+    # compositions after the metadata, as PyHAT expects
+    columns = [c for c in table.columns if not is_comp(c)] + [c for c in table.columns if is_comp(c)]
+    table = table.loc[table[key].isin(store.rows), columns]
+    wave = list(store.wave)
+
+    with open(path, 'w', newline='') as f:
+        header = pd.DataFrame([column_groups(columns, wave), columns + wave])
+        header.to_csv(f, index=False, header=False)
+
+        for start in range(0, len(table), chunk_rows):
+            chunk = table.iloc[start:start+chunk_rows].reset_index(drop=True)
+            # written as float64, like the merged table always was
+            spectra = pd.DataFrame(store.get_many(chunk[key]).astype('float64'), columns=wave)
+            pd.concat([chunk, spectra], axis=1).to_csv(f, index=False, header=False)
+
+    return len(table)
@@ -0,0 +1,341 @@
+import os
+import sys
+import argparse
+import warnings
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from spectral_store import SpectralStore
+from caltarget_monitor import load_truth
+
+# sol ranges as in caltarget_accuracy.py, at the top of the repo
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))
+from caltarget_accuracy import sol_ranges
+
+'''
+Caltarget mean spectra drift over the mission
+
+Streams the caltarget spectra of a spectral store, selected by target
+and sol from the metadata table, and reduces them to small summary
+arrays:
+
+    per target, sol range and channel    count, mean and std of the spectra
+                                         as stored (drift of the raw signal)
+    per spectrum                         emission line areas normalized by
+                                         the total emission, and line ratios
+    per channel and oxide                correlation of the normalized
+                                         spectra with the oxide's prediction
+                                         error, within targets
+
+Each target is one task on a process pool. A task reads its spectra
+through a memory map a chunk of rows at a time (chunk_mb), folding each
+chunk into the running moments, so memory stays bounded however many
+spectra there are. Prediction errors come from the true compositions
+(a table like the one the drift monitor reads).
+
+    python spectral_drift.py ChemCam <LIBS_CCS_mean_spectra_<date>> <LIBS_CCS_metadata_w_moc_<date>.csv> ChemCam_pred_true_summary.csv
+
+writes <prefix>_spectral_drift.npz and the line tables as .csv.
+'''
+
+# target column of each instrument's metadata
+TARGET = {
+    'ChemCam':'Target',
+    'SuperCam':'target'
+}
+
+# output prefix of each instrument
+PREFIX = {
+    'ChemCam':'LIBS_CCS',
+    'SuperCam':'LIBS_RDR'
+}
+
+# emission lines (nm) of the major elements, integrated over +/- line_width
+LINES = {
+    'Si':288.16,
+    'Ti':334.94,
+    'Al':396.15,
+    'Fe':259.94,
+    'Mg':279.55,
+    'Ca':393.37,
+    'Na':589.00,
+    'K':766.49,
+    'Mn':403.08,
+    'H':656.28,
+    'O':777.19
+}
+
+# numerator, denominator
+RATIOS = [(element, 'O') for element in ['Si','Ti','Al','Fe','Mg','Ca','Na','K','Mn','H']]
+
+#-----------#
+# SELECTION #
+#-----------#
+
+def select(meta, store, target='Target', targets=None, min_sol=None, max_sol=None):
+    '''
+    Rows of meta with a spectrum in store, for the given targets and
+    sols, with the store row of each and sorted by target and store row
+    '''
+    keep = meta.pkey.isin(store.rows)
+    if targets is not None:
+        keep &= meta[target].isin(targets)
+    if min_sol is not None:
+        keep &= meta.sol >= min_sol
+    if max_sol is not None:
+        keep &= meta.sol <= max_sol
+    meta = meta[keep].copy()
+    meta['row'] = meta.pkey.map(store.rows).astype('int64')
+    return meta.sort_values([target, 'row'], ignore_index=True)
+
+def prediction_errors(meta, truth, oxides, target='Target'):
+    '''
+    Predicted minus true composition of each row and oxide (NaN without both)
+    '''
+    actual = pd.DataFrame.from_dict(truth, orient='index').reindex(columns=oxides)
+    actual = actual.reindex(meta[target].astype(str)).to_numpy(dtype='float64')
+    return meta[oxides].to_numpy(dtype='float64') - actual
+
+def line_weights(wave, lines=LINES, line_width=0.5):
+    '''
+    (n_channels x n_lines) weights integrating each line over its window,
+    and the weights of the total emission. Lines outside the wavelength
+    axis are left out.
+    '''
+    wave = np.asarray(wave, dtype='float64')
+    dl = np.gradient(wave)
+    names, columns = [], []
+    for name, center in lines.items():
+        window = np.abs(wave - center) <= line_width
+        if not window.any():
+            warnings.warn(f'{name} line at {center} nm is outside the wavelength axis')
+            continue
+        names.append(name)
+        columns.append(np.where(window, dl, 0))
+    return names, np.column_stack(columns) if columns else np.empty((len(wave), 0)), dl
+
+#------------#
+# REDUCTIONS #
+#------------#
+
+def _target_drift(data, rows, bins, n_bins, errors, weights, dl, chunk_rows):
+    '''
+    Reductions of one target's spectra (rows of the store's data file,
+    data: (path, dtype, shape)) a chunk of rows at a time
+    '''
+    path, dtype, shape = data
+    matrix = np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    n_channels, k = shape[1], errors.shape[1]
+
+    n = np.zeros(n_bins, dtype='int64')
+    mean = np.zeros((n_bins, n_channels))
+    m2 = np.zeros((n_bins, n_channels))
+    lines = np.empty((len(rows), weights.shape[1]))
+    # sums for the channel/error correlation, of spectra shifted by the first chunk's mean
+    shift = None
+    sx, sxx, sxy = (np.zeros((n_channels, k)) for _ in range(3))
+    sy, syy, ny = (np.zeros(k) for _ in range(3))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for start in range(0, len(rows), chunk_rows):
+            x = np.asarray(matrix[rows[start:start+chunk_rows]], dtype='float64')
+            b = bins[start:start+chunk_rows]
+
+            # moments of each sol range in the chunk, merged into the running ones (Chan et al.)
+            order = np.argsort(b, kind='stable')
+            xs = x[order]
+            codes, first, counts = np.unique(b[order], return_index=True, return_counts=True)
+            chunk_mean = np.add.reduceat(xs, first, axis=0) / counts[:, None]
+            chunk_m2 = np.add.reduceat((xs - np.repeat(chunk_mean, counts, axis=0))**2, first, axis=0)
+            na, nb = n[codes][:, None], counts[:, None]
+            delta = chunk_mean - mean[codes]
+            mean[codes] += delta * nb / (na + nb)
+            m2[codes] += chunk_m2 + delta**2 * na * nb / (na + nb)
+            n[codes] += counts
+
+            # normalized by the total emission
+            xn = x / (x @ dl)[:, None]
+            lines[start:start+len(x)] = xn @ weights
+            if shift is None:
+                shift = xn.mean(axis=0)
+            xc = xn - shift
+            e = errors[start:start+chunk_rows]
+            valid = ~np.isnan(e)
+            v = valid.astype('float64')
+            y = np.where(valid, e, 0)
+            sx += xc.T @ v
+            sxx += (xc**2).T @ v
+            sxy += xc.T @ y
+            sy += y.sum(axis=0)
+            syy += (y**2).sum(axis=0)
+            ny += v.sum(axis=0)
+
+        # within-target (co)variances, zero for an oxide without errors
+        ny = np.where(ny > 0, ny, np.inf)
+        cov = sxy - sx * sy / ny
+        var_x = sxx - sx**2 / ny
+        var_y = syy - sy**2 / ny
+    return n, mean, m2, lines, cov, var_x, var_y
+
+def spectral_drift(store, meta, truth=None, target='Target', width=100, first_sol=None,
+                   lines=LINES, ratios=RATIOS, line_width=0.5, chunk_mb=64, n_procs=None):
+    '''
+    Reductions of the spectra of the rows of meta (pkey, sol, target and,
+    for the error correlation, oxide columns) as selected by select().
+    truth: {target: {oxide: true value}}, optional.
+    n_procs None uses one process per core, 0 runs in this process.
+
+    Returns a dict of summary arrays (see write_drift) and the per
+    spectrum line table.
+    '''
+    known = set() if truth is None else {o for t in truth.values() for o in t}
+    oxides = [c for c in meta.columns if c in known]
+    if len(meta) == 0:
+        raise ValueError('No spectra match the target and sol selection')
+    ranges = sol_ranges(meta.sol, width, first_sol)
+    codes, range_labels = np.asarray(ranges.codes, dtype='int64'), list(ranges.categories)
+    # sols before first_sol are in no range
+    keep = codes >= 0
+    meta, codes = meta[keep].reset_index(drop=True), codes[keep]
+    if len(meta) == 0:
+        raise ValueError(f'No selected spectra from sol {first_sol} on')
+    errors = prediction_errors(meta, truth, oxides, target) if truth is not None else np.empty((len(meta), 0))
+
+    line_names, weights, dl = line_weights(store.wave, lines, line_width)
+    row_bytes = store.n_channels * 8
+    # the chunk, its sorted and centred copies and the normalized spectra
+    chunk_rows = max(1, chunk_mb * 2**20 // (4 * row_bytes))
+    data = (store._data_path, store.dtype.str, (len(store), store.n_channels))
+
+    targets = meta[target].astype(str).unique().tolist()
+    groups = meta.groupby(meta[target].astype(str), sort=False).indices
+    tasks = [(data, meta.row.to_numpy()[groups[t]], codes[groups[t]], len(range_labels),
+              errors[groups[t]], weights, dl, chunk_rows) for t in targets]
+    if n_procs == 0:
+        results = [_target_drift(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_procs) as pool:
+            results = list(pool.map(_target_drift, *zip(*tasks)))
+
+    n = np.stack([r[0] for r in results])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(n[..., None] > 0, np.stack([r[1] for r in results]), np.nan)
+        std = np.sqrt(np.stack([r[2] for r in results]) / (n[..., None] - 1))
+        std[n < 2] = np.nan
+        # pooled within-target correlation of each channel with each oxide's error
+        cov, var_x, var_y = (np.sum([r[i] for r in results], axis=0) for i in (4, 5, 6))
+        corr = cov / np.sqrt(var_x * var_y)
+
+    spectra = meta[['pkey', target, 'sol']].copy()
+    spectra['sol_range'] = np.array(range_labels)[codes]
+    values = np.empty((len(meta), len(line_names)))
+    for t, r in zip(targets, results):
+        values[groups[t]] = r[3]
+    spectra[line_names] = values
+    for a, b in ratios:
+        if a in line_names and b in line_names:
+            spectra[f'{a}/{b}'] = spectra[a] / spectra[b]
+    for i, oxide in enumerate(oxides):
+        spectra[oxide+'_error'] = errors[:, i]
+
+    summary = {
+        'wave':store.wave,
+        'targets':np.array(targets),
+        'sol_ranges':np.array(range_labels),
+        'n':n,
+        'mean':mean.astype('float32'),
+        'std':std.astype('float32'),
+        'oxides':np.array(oxides),
+        'channel_error_corr':np.asarray(corr, dtype='float32').reshape(store.n_channels, len(oxides)),
+    }
+    return summary, spectra
+
+#--------------#
+# LINE TABLES  #
+#--------------#
+
+def line_features(spectra, target='Target'):
+    return [c for c in spectra.columns if c not in ['pkey', target, 'sol', 'sol_range'] and not c.endswith('_error')]
+
+def line_drift(spectra, target='Target'):
+    '''
+    Mean and std of each normalized line and ratio per target and sol range
+    '''
+    features = line_features(spectra, target)
+    groups = spectra.groupby([target, 'sol_range'], sort=False)
+    drift = pd.concat([groups[features].mean().add_suffix('_mean'),
+                       groups[features].std().add_suffix('_std')], axis=1)
+    drift = drift[sorted(drift.columns)]
+    drift.insert(0, 'n', groups.size())
+    return drift.reset_index()
+
+def line_error_corr(spectra, target='Target'):
+    '''
+    Correlation of each normalized line and ratio with each oxide's
+    prediction error, per target and pooled within targets ('all')
+    '''
+    features = line_features(spectra, target)
+    error_cols = [c for c in spectra.columns if c.endswith('_error')]
+    columns = features + error_cols
+    # pooled: deviations from each target's means
+    centred = spectra[columns] - spectra.groupby(target)[columns].transform('mean')
+    parts = [('all', centred)] + [(t, spectra.loc[spectra[target] == t, columns]) for t in spectra[target].unique()]
+
+    oxides = [e[:-len('_error')] for e in error_cols]
+    results = []
+    for name, values in parts:
+        # pairwise counts and correlations, line by oxide
+        present = values.notna().to_numpy(dtype='int64')
+        n = present[:, :len(features)].T @ present[:, len(features):]
+        r = values.corr(min_periods=3).loc[features, error_cols].to_numpy()
+        results.append(pd.DataFrame({target:name,
+                                     'line':np.repeat(features, len(oxides)),
+                                     'oxide':np.tile(oxides, len(features)),
+                                     'n':n.ravel(),
+                                     'r':r.ravel()}))
+    return pd.concat(results, ignore_index=True)
+
+def write_drift(prefix, summary, spectra, target='Target'):
+    '''
+    <prefix>_spectral_drift.npz with the summary arrays,
+    <prefix>_line_intensities.csv, <prefix>_line_drift.csv and
+    <prefix>_line_error_corr.csv
+    '''
+    np.savez_compressed(prefix+'_spectral_drift.npz', **summary)
+    spectra.to_csv(prefix+'_line_intensities.csv', index=False)
+    line_drift(spectra, target).to_csv(prefix+'_line_drift.csv', index=False)
+    if any(c.endswith('_error') for c in spectra.columns):
+        line_error_corr(spectra, target).to_csv(prefix+'_line_error_corr.csv', index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drift of the caltarget mean spectra by sol range')
+    parser.add_argument('instrument', choices=list(TARGET))
+    parser.add_argument('store', help='LIBS_*_mean_spectra_<date> spectral store folder')
+    parser.add_argument('meta', help='metadata .csv with predicted compositions')
+    parser.add_argument('truth', nargs='?', help='true compositions (target and <oxide>_actual columns)')
+    parser.add_argument('--targets', nargs='+', help='targets to include (default those in truth)')
+    parser.add_argument('--min-sol', type=int)
+    parser.add_argument('--max-sol', type=int)
+    parser.add_argument('--width', type=int, default=100, help='sols per range')
+    parser.add_argument('--chunk-mb', type=int, default=64, help='memory per chunk of spectra')
+    parser.add_argument('--n-procs', type=int, default=None, help='processes (0 for this process only)')
+    parser.add_argument('--out', help='prefix of the output files (default LIBS_CCS / LIBS_RDR)')
+    args = parser.parse_args()
+
+    target = TARGET[args.instrument]
+    truth = load_truth(args.truth, target) if args.truth else None
+    targets = args.targets or (list(truth) if truth is not None else None)
+    if targets is None:
+        parser.error('give --targets or a truth table')
+
+    store = SpectralStore(args.store)
+    meta = pd.read_csv(args.meta, dtype={target:str})
+    meta = select(meta, store, target, targets, args.min_sol, args.max_sol)
+    if len(meta) == 0:
+        sys.exit(f'No spectra in {args.store} for the selected targets and sols')
+    summary, spectra = spectral_drift(store, meta, truth, target, args.width,
+                                      chunk_mb=args.chunk_mb, n_procs=args.n_procs)
+    write_drift(args.out or PREFIX[args.instrument], summary, spectra, target)
+    print(f'{len(spectra)} spectra of {len(summary["targets"])} targets in {len(summary["sol_ranges"])} sol ranges')
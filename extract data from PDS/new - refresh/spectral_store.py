@@ -0,0 +1,244 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+
+'''
+Binary spectral store for mean spectra
+
+Replaces the wide LIBS_*_mean_spectra.csv files. A store is a folder with
+    store.json  - dtype and number of channels
+    wave.npy    - the wavelength axis shared by every spectrum
+    spectra.bin - one row per spectrum, raw little-endian values
+    index.csv   - pkey of each row, in row order
+
+New spectra are appended to the end of spectra.bin and index.csv, so
+nothing already written is parsed or rewritten. Reads go through a
+memory map, so pulling one spectrum or a few thousand only touches those
+rows.
+'''
+
+def same_wave(wave, reference):
+    '''
+    Whether wave is the reference wavelength axis (to 1e-4)
+    '''
+    wave = np.asarray(wave, dtype='float64')
+    return len(wave) == len(reference) and np.allclose(wave, reference, rtol=0, atol=1e-4)
+
+def majority_wave(waves):
+    '''
+    The wavelength axis shared by more than half of waves (None for a
+    product that couldn't be read), so one odd product doesn't set the
+    axis of a new store. Raises ValueError if there is no such axis.
+    '''
+    groups = []
+    for wave in waves:
+        if wave is None:
+            continue
+        for group in groups:
+            if same_wave(wave, group[0]):
+                group.append(wave)
+                break
+        else:
+            groups.append([np.asarray(wave, dtype='float64')])
+    best = max(groups, key=len, default=[])
+    if 2 * len(best) <= len(waves):
+        raise ValueError(f'No wavelength axis shared by most of the {len(waves)} sampled products '
+                         f'({", ".join(str(len(g)) for g in groups) or "none readable"})')
+    return best[0]
+
+def reference_wave(dl, products, read_wave, n=5):
+    '''
+    Wavelength axis for a new store: the majority axis (majority_wave)
+    of n (pkey, sol, url) products spread over products, downloaded with
+    dl and read with read_wave(data)
+    '''
+    def sample(product):
+        try:
+            return read_wave(dl.get_content(product[2]))
+        except (OSError, ValueError, KeyError):
+            return None
+    return majority_wave(list(dl.imap(sample, products[::max(1, len(products) // n)][:n])))
+
+class SpectralStore:
+
+    def __init__(self, folder, wave=None, dtype='float32'):
+        '''
+        Open the store in folder, creating it if wave is given and it
+        doesn't exist yet
+        '''
+        self.folder = folder
+        self._info_path = os.path.join(folder, 'store.json')
+        self._wave_path = os.path.join(folder, 'wave.npy')
+        self._data_path = os.path.join(folder, 'spectra.bin')
+        self._index_path = os.path.join(folder, 'index.csv')
+
+        if not os.path.exists(self._info_path):
+            if wave is None:
+                raise FileNotFoundError(f'No spectral store in {folder}')
+            self._create(np.asarray(wave, dtype='float64'), dtype)
+
+        with open(self._info_path) as f:
+            info = json.load(f)
+        self.dtype = np.dtype(info['dtype']).newbyteorder('<')
+        self.n_channels = info['n_channels']
+        self.wave = np.load(self._wave_path)
+
+        # only complete lines count, a run that broke mid-write leaves a partial one,
+        # which is cut off so the next append starts on a fresh line
+        with open(self._index_path, 'rb') as f:
+            content = f.read()
+        complete = content.rfind(b'\n') + 1
+        if complete < len(content):
+            with open(self._index_path, 'r+b') as f:
+                f.truncate(complete)
+        self.pkeys = content[:complete].decode().splitlines()[1:]
+        self.rows = {pkey:i for i, pkey in enumerate(self.pkeys)}
+
+        # drop any rows written without making it into the index
+        row_bytes = self.n_channels * self.dtype.itemsize
+        if os.path.getsize(self._data_path) != len(self.pkeys) * row_bytes:
+            with open(self._data_path, 'r+b') as f:
+                f.truncate(len(self.pkeys) * row_bytes)
+
+    @staticmethod
+    def exists(folder):
+        return os.path.exists(os.path.join(folder, 'store.json'))
+
+    def _create(self, wave, dtype):
+        os.makedirs(self.folder, exist_ok=True)
+        np.save(self._wave_path, wave)
+        open(self._data_path, 'wb').close()
+        with open(self._index_path, 'w') as f:
+            f.write('pkey\n')
+        # written last, so an interrupted create is simply redone
+        with open(self._info_path, 'w') as f:
+            json.dump({'dtype':np.dtype(dtype).name, 'n_channels':len(wave)}, f)
+
+    def __len__(self):
+        return len(self.pkeys)
+
+    def __contains__(self, pkey):
+        return pkey in self.rows
+
+    def check_wave(self, wave):
+        if not same_wave(wave, self.wave):
+            raise ValueError('Wavelength axis does not match the spectral store')
+
+    def append(self, pkeys, spectra, wave=None):
+        '''
+        Append spectra (one row per pkey) to the end of the store.
+        pkeys already in the store are skipped.
+        '''
+        if wave is not None:
+            self.check_wave(wave)
+        spectra = np.asarray(spectra)
+        if spectra.ndim != 2 or spectra.shape != (len(pkeys), self.n_channels):
+            raise ValueError(f'Expected spectra of shape ({len(pkeys)}, {self.n_channels}), got {spectra.shape}')
+
+        keep = [i for i, pkey in enumerate(pkeys) if pkey not in self.rows]
+        if len(keep) == 0:
+            return
+        if len(keep) < len(pkeys):
+            pkeys = [pkeys[i] for i in keep]
+            spectra = spectra[keep]
+
+        # data first, then index: a row only counts once it is indexed
+        with open(self._data_path, 'ab') as f:
+            f.write(np.ascontiguousarray(spectra, dtype=self.dtype).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self._index_path, 'a') as f:
+            f.write(''.join(f'{pkey}\n' for pkey in pkeys))
+
+        for pkey in pkeys:
+            self.rows[pkey] = len(self.pkeys)
+            self.pkeys.append(pkey)
+
+    def matrix(self):
+        '''
+        Read-only memory map of all spectra, shape (n_spectra, n_channels)
+        '''
+        if len(self.pkeys) == 0:
+            return np.empty((0, self.n_channels), dtype=self.dtype)
+        return np.memmap(self._data_path, dtype=self.dtype, mode='r',
+                         shape=(len(self.pkeys), self.n_channels))
+
+    def get(self, pkey):
+        return np.array(self.matrix()[self.rows[pkey]])
+
+    def get_many(self, pkeys):
+        rows = [self.rows[pkey] for pkey in pkeys]
+        return np.array(self.matrix()[rows])
+
+    def to_frame(self, pkeys=None):
+        '''
+        Wide DataFrame in the mean spectra .csv layout (wave + one column per pkey)
+        '''
+        pkeys = self.pkeys if pkeys is None else list(pkeys)
+        df = pd.DataFrame(self.get_many(pkeys).T, columns=pkeys)
+        df.insert(0, 'wave', self.wave)
+        return df
+
+    def to_csv(self, path, chunk_channels=500):
+        '''
+        Write the wide mean spectra .csv, a block of channels at a time
+        '''
+        matrix = self.matrix()
+        header = True
+        with open(path, 'w', newline='') as f:
+            for start in range(0, self.n_channels, chunk_channels):
+                stop = min(start + chunk_channels, self.n_channels)
+                df = pd.DataFrame(np.array(matrix[:, start:stop]).T, columns=self.pkeys)
+                df.insert(0, 'wave', self.wave[start:stop])
+                df.to_csv(f, index=False, header=header)
+                header = False
+
+
+class SpectraAccumulator:
+    '''
+    Collects spectra for a batch in a preallocated block that doubles
+    when full, then hands them to a SpectralStore in one append
+    '''
+
+    def __init__(self, dtype='float32', capacity=256):
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self.wave = None
+        self.pkeys = []
+        self._block = None
+
+    def __len__(self):
+        return len(self.pkeys)
+
+    def add(self, pkey, spectrum, wave=None):
+        # the first spectrum fixes the wavelength axis for the batch
+        if self._block is None:
+            if wave is None:
+                raise ValueError('The first spectrum needs its wavelength axis')
+            self.wave = np.asarray(wave, dtype='float64')
+            self._block = np.empty((self.capacity, len(self.wave)), dtype=self.dtype)
+        # (a shared grid passed back in is the same object, no need to compare)
+        elif wave is not None and wave is not self.wave and not np.array_equal(np.asarray(wave, dtype='float64'), self.wave):
+            raise ValueError(f'{pkey} has a different wavelength axis')
+
+        n = len(self.pkeys)
+        if n == len(self._block):
+            grown = np.empty((2 * len(self._block), self._block.shape[1]), dtype=self.dtype)
+            grown[:n] = self._block
+            self._block = grown
+        self._block[n] = spectrum
+        self.pkeys.append(pkey)
+
+    def block(self):
+        if self._block is None:
+            return np.empty((0, 0), dtype=self.dtype)
+        return self._block[:len(self.pkeys)]
+
+    def flush(self, store):
+        '''
+        Append the batch to store and start a new one
+        '''
+        if len(self.pkeys) > 0:
+            store.append(self.pkeys, self.block(), wave=self.wave)
+        self.pkeys = []
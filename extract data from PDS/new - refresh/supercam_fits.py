@@ -0,0 +1,111 @@
+import io
+import numpy as np
+import pandas as pd
+from numpy.lib.recfunctions import structured_to_unstructured
+from astropy.io import fits
+
+from pds_metrics import timed
+from spectral_store import same_wave
+
+'''
+FITS access for SuperCam LIBS RDR products
+
+Downloaded products are parsed straight from memory, without a round
+trip through disk. open_bytes returns an HDUList to use as a context
+manager, so the handle is closed as soon as the product has been
+converted.
+
+parse_product turns the laser, spectra, statistics, wavelength and
+saturation extensions into native-endian arrays, one conversion per HDU.
+'''
+
+def open_bytes(data):
+    '''
+    HDUList parsed from the downloaded bytes of a .fits product
+    '''
+    return fits.open(io.BytesIO(data), memmap=False)
+
+def hdu_to_array(hdu, dtype='float64'):
+    '''
+    Contiguous native-endian (rows, columns) array of a binary table or
+    image HDU, plus the table column names (None for images)
+    '''
+    data = hdu.data
+    if data.dtype.names is None:
+        return np.ascontiguousarray(data, dtype=dtype), None
+
+    names = list(data.dtype.names)
+    # scaled columns need astropy to apply TSCAL/TZERO, so go column by column
+    if any(c.bscale not in (None, 1) or c.bzero not in (None, 0) for c in hdu.columns):
+        array = np.column_stack([np.asarray(data[n], dtype=dtype) for n in names])
+    # otherwise one cast of the whole record array, byte swapping included
+    else:
+        array = structured_to_unstructured(data.view(np.ndarray), dtype=dtype)
+    return np.ascontiguousarray(array), names
+
+def read_wave(data):
+    '''
+    Wavelength grid of the downloaded bytes of a .fits product
+    '''
+    with open_bytes(data) as hdul:
+        array, names = hdu_to_array(hdul['WAVELENGTH'])
+    return array[:, names.index('Wavelength')]
+
+def parse_product(hdul, wave=None, dtype='float64'):
+    '''
+    Laser table and combined spectra table (wavelength, statistics, all
+    shots and saturation masks) of a LIBS RDR product as DataFrames.
+
+    wave is the shared SuperCam wavelength grid; if given, a product on
+    another grid raises ValueError.
+    '''
+    laser, laser_cols = hdu_to_array(hdul['LASERDATA'], dtype)
+
+    arrays = []
+    cols = []
+    for name in ['WAVELENGTH', 'STATISTICS', 'SPECTRA', 'SATURATION']:
+        array, names = hdu_to_array(hdul[name], dtype)
+        arrays.append(array)
+        cols.extend(names)
+    table = np.concatenate(arrays, axis=1)
+
+    if wave is not None and not same_wave(table[:, cols.index('Wavelength')], wave):
+        raise ValueError('Wavelength grid does not match the shared SuperCam grid')
+
+    return pd.DataFrame(laser, columns=laser_cols), pd.DataFrame(table, columns=cols)
+
+def process_product(product, data, wave=None, laser_folder=None, spectra_folder=None, fits_folder=None, dtype='float64'):
+    '''
+    Parse one downloaded (pkey, sol, url) product and write its laser and
+    spectra .csv files, plus the raw .fits if fits_folder is given. Runs
+    on the ingest pipeline's worker processes.
+
+    wave is the shared SuperCam wavelength grid the product is checked
+    against (chosen in the main process, see the ingest script).
+
+    Returns the mean spectrum and, when no .csv folders are given, the
+    tables themselves as {name: (array, columns)} for the main process
+    to store.
+    '''
+    pkey = product[0]
+
+    # archive raw file
+    if fits_folder is not None:
+        with timed('fits archive'), open(f'{fits_folder}\\{pkey}.fits', 'wb') as file:
+            file.write(data)
+
+    # parse in memory, closed once the tables are extracted
+    with timed('fits decode'), open_bytes(data) as hdul:
+        laser, table = parse_product(hdul, wave, dtype)
+    mean = table['Mean'].values
+
+    if laser_folder is None:
+        tables = {'laser':(laser.values, list(laser.columns)),
+                  'spectra':(table.values, list(table.columns))}
+        return mean, tables
+
+    with timed('csv write'):
+        laser.to_csv(f'{laser_folder}\\{pkey}.csv', index=False)
+        table.to_csv(f'{spectra_folder}\\{pkey}.csv', index=False)
+
+    return mean, None